@@ -1,29 +1,123 @@
+import abc
+import argparse
+import array
+import asyncio
+import bisect
+import concurrent.futures
+import contextlib
+import contextvars
 import csv
 import dataclasses
 import datetime
 import functools
+import gzip
+import hashlib
+import http.client
+import http.server
+import itertools
 import json
 import logging
+import math
+import multiprocessing
 import os
+import queue
+import random
+import re
+import signal
+import threading
+import sys
 import time
-from collections.abc import Iterator, Iterable
-from typing import Any
+import typing
+from collections.abc import Awaitable, Callable, Iterator, Iterable, Sequence
+from typing import Any, TypeVar
 
+import aiohttp
+import elastic_transport
 import elasticsearch
+import urllib3
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 LOG = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 API_KEY: str | None = os.getenv("ESPROBER_API_KEY", "").strip() or None
 API_URL: str = (os.getenv("ESPROBER_API_URL", "").strip() or "https://overview-elastic-cloud-com.es.us-east-1.aws.found.io:443").rstrip("/")
+CLUSTERS_FILENAME = os.path.expanduser(os.getenv("ESPROBER_CLUSTERS_FILENAME", "clusters.json"))
 
 LOG_FILENAME = os.path.expanduser(os.getenv("ESPROBER_LOG_FILENAME", "esprober.log"))
+# Logging level: per-request messages are logged at DEBUG level
+LOG_LEVEL: str = os.getenv("ESPROBER_LOG_LEVEL", "").strip().upper() or "DEBUG"
 QUERIES_FILENAME = os.path.expanduser(os.getenv("ESPROBER_QUERIES_FILENAME", "queries.json"))
-RESULTS_FILENAME = os.path.expanduser(os.getenv("ESPROBER_CSV_FILENAME", "results.csv"))
+# JSON lines capture of search requests replayed by 'replay' engine
+REPLAY_FILENAME = os.path.expanduser(os.getenv("ESPROBER_REPLAY_FILENAME", "requests.jsonl"))
+RESULTS_FORMAT: str = os.getenv("ESPROBER_RESULTS_FORMAT", "").strip().lower() or "csv"
+RESULTS_FILENAME = os.path.expanduser(
+    os.getenv("ESPROBER_RESULTS_FILENAME", "").strip() or
+    os.getenv("ESPROBER_CSV_FILENAME", "").strip() or
+    ("results.csv" if RESULTS_FORMAT == "csv" else "results")
+)
+SUMMARY_FILENAME = os.path.expanduser(os.getenv("ESPROBER_SUMMARY_FILENAME", "").strip() or f"{RESULTS_FILENAME}.summary.json")
 
-QUERY_INTERVAL: float = max(1., float(os.getenv("ESPROBER_QUERY_INTERVAL", "").strip() or 60.))
+# Load profile executed by 'profile' engine, and the report of its latency per step
+LOAD_PROFILE_FILENAME = os.path.expanduser(os.getenv("ESPROBER_LOAD_PROFILE_FILENAME", "profile.json"))
+PROFILE_REPORT_FILENAME = os.path.expanduser(
+    os.getenv("ESPROBER_PROFILE_REPORT_FILENAME", "").strip() or f"{RESULTS_FILENAME}.profile.json")
+# The p99 latency (in seconds) a load profile step has to exceed for being reported as the latency knee
+LATENCY_THRESHOLD: float = max(0., float(os.getenv("ESPROBER_LATENCY_THRESHOLD", "").strip() or 1.))
+ENGINE: str = os.getenv("ESPROBER_ENGINE", "").strip().lower() or "async"
+CONCURRENCY: int = max(1, int(os.getenv("ESPROBER_CONCURRENCY", "").strip() or 1))
+# Factor the inter-arrival times of replayed requests are divided by
+REPLAY_SPEED: float = max(0.001, float(os.getenv("ESPROBER_REPLAY_SPEED", "").strip() or 1.))
+# Maximum requests per second sent for all queries together, and how many of them can be sent in a burst
+RATE_LIMIT: float | None = max(0., float(os.getenv("ESPROBER_RATE_LIMIT", "").strip() or 0.)) or None
+RATE_BURST: int = max(1, int(os.getenv("ESPROBER_RATE_BURST", "").strip() or 1))
+PROCESSES: int = max(1, int(os.getenv("ESPROBER_PROCESSES", "").strip() or 1))
+QUERY_INTERVAL: float = max(0., float(os.getenv("ESPROBER_QUERY_INTERVAL", "").strip() or 60.))
+# Maximum random delay (in seconds) added to every scheduled request
+JITTER: float = max(0., float(os.getenv("ESPROBER_JITTER", "").strip() or 0.))
+# It makes the schedules of the concurrent tasks of a query be evenly staggered over the interval
+STAGGER: bool = (os.getenv("ESPROBER_STAGGER", "").strip().lower() or "false") in ("true", "yes", "1")
+QUERY_RATE: float | None = max(0., float(os.getenv("ESPROBER_QUERY_RATE", "").strip() or 0.)) or None
 TEST_DURATION: float | None = max(0., float(os.getenv("ESPROBER_TEST_DURATION", "").strip() or 0.)) or None
 REQUEST_TIMEOUT: float = max(1., float(os.getenv("ESPROBER_REQUEST_TIMEOUT", "").strip() or 120.))
+POOL_SIZE: int = max(1, int(os.getenv("ESPROBER_POOL_SIZE", "").strip() or 10))
+WARMUP_COUNT: int = max(0, int(os.getenv("ESPROBER_WARMUP_COUNT", "").strip() or 0))
+WARMUP_DURATION: float = max(0., float(os.getenv("ESPROBER_WARMUP_DURATION", "").strip() or 0.))
+# What to do with warm-up results: 'discard' them or 'tag' them before writing them
+WARMUP_RESULTS: str = os.getenv("ESPROBER_WARMUP_RESULTS", "").strip().lower() or "discard"
+TEMPLATE_BATCH_SIZE: int = max(1, int(os.getenv("ESPROBER_TEMPLATE_BATCH_SIZE", "").strip() or 1000))
+# It makes request bodies be serialized only once, when loading queries
+RAW_REQUESTS: bool = (os.getenv("ESPROBER_RAW_REQUESTS", "").strip().lower() or "false") in ("true", "yes", "1")
+# How search responses are handled: 'full' (parse them), 'minimal' (request only the statistics being
+# recorded) or 'discard' (skip parsing hits)
+RESPONSE_MODE: str = os.getenv("ESPROBER_RESPONSE", "").strip().lower() or "full"
+# It makes queries to the same cluster be sent together by _msearch requests
+MSEARCH: bool = (os.getenv("ESPROBER_MSEARCH", "").strip().lower() or "false") in ("true", "yes", "1")
+KEEP_ALIVE: bool = (os.getenv("ESPROBER_KEEP_ALIVE", "").strip().lower() or "true") in ("true", "yes", "1")
+SUMMARY_INTERVAL: float = max(0., float(os.getenv("ESPROBER_SUMMARY_INTERVAL", "").strip() or 60.))
+# Durations (in seconds) of the sliding windows of live latency statistics, and smoothing factor of their EWMA
+ROLLING_WINDOWS: list[float] = [
+    float(w) for w in (os.getenv("ESPROBER_ROLLING_WINDOWS", "").strip() or "300,3600").split(",") if w.strip()]
+EWMA_ALPHA: float = min(1., max(0.001, float(os.getenv("ESPROBER_EWMA_ALPHA", "").strip() or 0.1)))
+# Address of the HTTP server exposing Prometheus metrics (disabled when port is 0)
+METRICS_HOST: str = os.getenv("ESPROBER_METRICS_HOST", "").strip() or "0.0.0.0"
+METRICS_PORT: int = max(0, int(os.getenv("ESPROBER_METRICS_PORT", "").strip() or 0))
+WRITE_BATCH_SIZE: int = max(1, int(os.getenv("ESPROBER_WRITE_BATCH_SIZE", "").strip() or 1000))
+WRITE_INTERVAL: float = max(0.1, float(os.getenv("ESPROBER_WRITE_INTERVAL", "").strip() or 1.))
+
+
+@dataclasses.dataclass(frozen=True)
+class Cluster:
+    # None stands for the only cluster configured by environment variables
+    name: str | None = None
+    url: str = API_URL
+    api_key: str | None = API_KEY
 
 
 @dataclasses.dataclass
@@ -31,17 +125,419 @@ class Query:
     name: str
     path: str
     body: dict[str, Any]
+    # Requests per second to be sent in open-loop mode (it overrides ESPROBER_QUERY_RATE)
+    rate: float | None = None
+    # Maximum requests per second to be sent, and how many of them can be sent in a burst
+    rate_limit: float | None = None
+    burst: int = 1
+    # Offset (in seconds) of the schedule of the query, and maximum random delay of every request (see Schedule)
+    phase: float = 0.
+    jitter: float = JITTER
+    # Names of the clusters the query has to be sent to (all of them when None)
+    clusters: list[str] | None = None
+    # The cluster the query is sent to
+    cluster: Cluster = Cluster()
+    # Pools of values for filling '{{name}}' placeholders of the body (see ParameterPool.from_spec)
+    params: dict[str, Any] | None = None
+    # It makes request bodies be serialized ahead of sending them (see prepare method)
+    raw: bool = RAW_REQUESTS
+    # How search responses are handled (see RESPONSE_MODES)
+    response: str = RESPONSE_MODE
+    template: 'BodyTemplate | None' = dataclasses.field(default=None, init=False, repr=False, compare=False)
+    prepared: 'PreparedRequest | None' = dataclasses.field(default=None, init=False, repr=False, compare=False)
+    limiter: 'TokenBucket | None' = dataclasses.field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        if self.response not in RESPONSE_MODES:
+            raise ValueError(f"Unsupported response mode for query '{self.name}': '{self.response}'.")
+        if self.rate_limit:
+            self.limiter = TokenBucket(rate=self.rate_limit, burst=self.burst)
+        if self.params:
+            self.template = BodyTemplate(
+                body=self.body,
+                pools={name: ParameterPool.from_spec(spec) for name, spec in self.params.items()},
+            )
+
+    @property
+    def key(self) -> str:
+        return query_key(self.name, self.cluster.name)
+
+    def prepare(self) -> None:
+        """It serializes request bodies once, so that requests are sent as raw bytes."""
+        if self.template is not None:
+            self.template.prepare = self.prepare_request
+        else:
+            self.prepared = self.prepare_request(self.body)
+
+    def prepare_request(self, body: dict[str, Any]) -> 'PreparedRequest':
+        return PreparedRequest.from_search(client(self.cluster), **self.search_kwargs(body))
+
+    def search_kwargs(self, body: dict[str, Any]) -> dict[str, Any]:
+        """It returns the arguments of client search method for sending given body."""
+        if self.response == "minimal":
+            # Body parameters take precedence over the ones reducing the response
+            return {"index": self.path or None, "size": 0, "_source": False, **body,
+                    "filter_path": MINIMAL_FILTER_PATH}
+        return {"index": self.path or None, **body}
+
+    def msearch_item(self) -> list[dict[str, Any]]:
+        """It returns the header and the body of the query as an item of a _msearch request."""
+        body = self.body if self.template is None else self.template.next_body()
+        if self.response == "minimal":
+            body = {"size": 0, "_source": False, **body}
+        return [{"index": self.path} if self.path else {}, body]
+
+    def next_request(self) -> 'dict[str, Any] | PreparedRequest':
+        if self.prepared is not None:
+            return self.prepared
+        if self.template is not None:
+            return self.template.next_body()
+        return self.body
 
     def send(self) -> 'QueryResult':
-        url = f"{API_URL}/{self.path}".rstrip("/")
-        timestamp = datetime.datetime.strftime(
-            datetime.datetime.now(datetime.timezone.utc),
-            "%Y-%m-%dT%H:%M:%S.%f"
-        )[:-3]
-        start_time = time.monotonic()
-        client(url).search(**self.body)
-        duration = time.monotonic() - start_time
-        return QueryResult(timestamp=timestamp, duration=duration, name=self.name)
+        request = self.next_request()
+        with timed_request(discard_hits=self.response == "discard") as timings:
+            if isinstance(request, PreparedRequest):
+                response = request.send(client(self.cluster))
+            else:
+                response = client(self.cluster).search(**self.search_kwargs(request))
+        return self.result(response, timings)
+
+    async def async_send(self, start_time: float | None = None) -> 'QueryResult':
+        """It sends the query measuring its duration since start_time (monotonic), or since now when it is None."""
+        request = self.next_request()
+        with timed_request(start_time, discard_hits=self.response == "discard") as timings:
+            if isinstance(request, PreparedRequest):
+                response = await request.send(async_client(self.cluster))
+            else:
+                response = await async_client(self.cluster).search(**self.search_kwargs(request))
+        return self.result(response, timings)
+
+    def result(self, response: elastic_transport.ObjectApiResponse, timings: 'RequestTimings') -> 'QueryResult':
+        return QueryResult.from_response(response, timings, timestamp=timings.timestamp, name=self.name,
+                                         cluster=self.cluster.name, duration=timings.duration)
+
+
+RESPONSE_MODES = ("full", "minimal", "discard")
+# Response fields QueryResult.from_response reads
+MINIMAL_FILTER_PATH = "took,timed_out,_shards,hits.total"
+
+
+@dataclasses.dataclass
+class MultiSearch:
+    """Queries to the same cluster sent together by a single _msearch request.
+
+    Every round trip produces a result for every query (having its own took, and the round trip duration)
+    plus a result for the whole request, named after the multi search.
+    """
+    queries: list[Query]
+    name: str = "_msearch"
+    # Requests per second to be sent in open-loop mode (it overrides ESPROBER_QUERY_RATE)
+    rate: float | None = None
+    phase: float = 0.
+    jitter: float = JITTER
+    prepared: 'PreparedRequest | None' = dataclasses.field(default=None, init=False, repr=False, compare=False)
+    # Multi searches are limited by the global rate limit only
+    limiter: 'TokenBucket | None' = dataclasses.field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def cluster(self) -> Cluster:
+        return self.queries[0].cluster
+
+    @property
+    def key(self) -> str:
+        return query_key(self.name, self.cluster.name)
+
+    @property
+    def raw(self) -> bool:
+        return any(q.raw for q in self.queries)
+
+    @property
+    def keys(self) -> list[str]:
+        """Keys of the results of every round trip."""
+        return [self.key] + [q.key for q in self.queries]
+
+    def prepare(self) -> None:
+        """It serializes the request once, unless queries bodies are rendered from templates."""
+        if all(q.template is None for q in self.queries):
+            self.prepared = PreparedRequest.from_api(client(self.cluster), "msearch", **self.msearch_kwargs())
+
+    def next_request(self) -> 'dict[str, Any] | PreparedRequest':
+        if self.prepared is not None:
+            return self.prepared
+        return self.msearch_kwargs()
+
+    def msearch_kwargs(self) -> dict[str, Any]:
+        kwargs: dict[str, Any] = {"searches": [x for q in self.queries for x in q.msearch_item()]}
+        if all(q.response == "minimal" for q in self.queries):
+            kwargs["filter_path"] = "took," + ",".join(
+                f"responses.{f}" for f in MINIMAL_FILTER_PATH.split(",") + ["status", "error"])
+        return kwargs
+
+    def send(self) -> list['QueryResult']:
+        request = self.next_request()
+        with timed_request() as timings:
+            if isinstance(request, PreparedRequest):
+                response = request.send(client(self.cluster))
+            else:
+                response = client(self.cluster).msearch(**request)
+        return self.results(response, timings)
+
+    async def async_send(self, start_time: float | None = None) -> list['QueryResult']:
+        """It sends the queries measuring the duration since start_time (monotonic), or since now when it is None."""
+        request = self.next_request()
+        with timed_request(start_time) as timings:
+            if isinstance(request, PreparedRequest):
+                response = await request.send(async_client(self.cluster))
+            else:
+                response = await async_client(self.cluster).msearch(**request)
+        return self.results(response, timings)
+
+    def results(self, response: elastic_transport.ObjectApiResponse, timings: 'RequestTimings') -> list['QueryResult']:
+        results = [QueryResult.from_response(response, timings, timestamp=timings.timestamp, name=self.name,
+                                             cluster=self.cluster.name, duration=timings.duration)]
+        for q, item in zip(self.queries, response.body.get("responses", [])):
+            if "error" in item:
+                LOG.error("Query '%s' failed: %s", q.key, item["error"])
+                METRICS.request_failed(q.key)
+                continue
+            results.append(QueryResult.from_body(item, timestamp=timings.timestamp, name=q.name,
+                                                 cluster=q.cluster.name, duration=timings.duration))
+        return results
+
+
+# Anything engines can send
+Probe = Query | MultiSearch
+
+
+@dataclasses.dataclass
+class PreparedRequest:
+    """Request having its body already serialized, to be sent with client perform_request method."""
+    method: str
+    path: str
+    params: dict[str, Any]
+    headers: dict[str, str]
+    body: bytes | None
+
+    def send(self, c: elasticsearch.Elasticsearch | elasticsearch.AsyncElasticsearch) -> Any:
+        return c.perform_request(self.method, self.path, params=self.params, headers=self.headers, body=self.body)
+
+    @classmethod
+    def from_search(cls, c: elasticsearch.Elasticsearch, **kwargs: Any) -> 'PreparedRequest':
+        """It prepares the request the search method of given client would send with given arguments."""
+        return cls.from_api(c, "search", **kwargs)
+
+    @classmethod
+    def from_api(cls, c: elasticsearch.Elasticsearch, api: str, **kwargs: Any) -> 'PreparedRequest':
+        """It prepares the request the api method of given client would send with given arguments."""
+        getattr(capturing_client(c), api)(**kwargs)
+        return CAPTURED_REQUESTS.request
+
+
+# Last request captured by every thread (see capturing_client)
+CAPTURED_REQUESTS = threading.local()
+
+
+@functools.cache
+def capturing_client(c: elasticsearch.Elasticsearch) -> elasticsearch.Elasticsearch:
+    """It returns a copy of given client capturing requests (in CAPTURED_REQUESTS) instead of sending them."""
+
+    def perform_request(method: str, path: str, *, params: Any = None, headers: Any = None, body: Any = None,
+                        **_: Any) -> None:
+        headers = dict(headers or {})
+        if body is not None:
+            body = c.transport.serializers.dumps(body, mimetype=headers.get("content-type"))
+        CAPTURED_REQUESTS.request = PreparedRequest(
+            method=method, path=path, params=dict(params or {}), headers=headers, body=body)
+
+    # Client copies share the transport, but not the instance attributes
+    capture = c.options()
+    capture.perform_request = perform_request  # type: ignore[method-assign]
+    return capture
+
+
+@dataclasses.dataclass
+class ParameterPool:
+    """Pool of values a body template parameter is randomly drawn from.
+
+    Values are drawn from a list of values, or by calling a method of random.Random with given arguments.
+    """
+    values: list[Any] | None = None
+    method: str | None = None
+    kwargs: dict[str, Any] = dataclasses.field(default_factory=dict)
+
+    METHODS: typing.ClassVar[tuple[str, ...]] = (
+        "randrange", "randint", "uniform", "triangular", "gauss", "normalvariate", "lognormvariate",
+        "expovariate", "paretovariate", "weibullvariate",
+    )
+
+    def draw(self, rng: random.Random) -> Any:
+        if self.values is not None:
+            return rng.choice(self.values)
+        return getattr(rng, self.method)(**self.kwargs)
+
+    @classmethod
+    def from_spec(cls, spec: Any) -> 'ParameterPool':
+        """It creates a pool from its specification in queries file, which can be:
+        - a list of values: ["a", "b"];
+        - a file with a value per line: {"file": "values.txt"};
+        - a range of integers: {"range": [start, stop, step]};
+        - a random distribution: {"random": "uniform", "a": 0, "b": 10} (any method of random.Random
+          listed in METHODS with its keyword arguments).
+        """
+        if isinstance(spec, list) and spec:
+            return cls(values=spec)
+        if isinstance(spec, dict):
+            if "file" in spec:
+                with open(os.path.expanduser(spec["file"])) as f:
+                    values = [line.strip() for line in f if line.strip()]
+                if values:
+                    return cls(values=values)
+            elif "range" in spec:
+                return cls(method="randrange", kwargs=dict(zip(("start", "stop", "step"), spec["range"])))
+            elif spec.get("random") in cls.METHODS:
+                return cls(method=spec["random"], kwargs={k: v for k, v in spec.items() if k != "random"})
+        raise ValueError(f"Invalid parameter pool: {spec!r}")
+
+
+class BodyTemplate:
+    """Query body having '{{name}}' placeholders replaced by values drawn from parameter pools.
+
+    A placeholder making a whole string is replaced by the value itself (keeping its type), otherwise it is
+    formatted into the string. Bodies are rendered (and prepared, when prepare function is given) in batches
+    ahead of the requests using them, so that rendering doesn't add to measured durations. Next batch is
+    rendered by a background thread while the current one is used, so that rendering doesn't stall the
+    event loop either.
+    """
+
+    PLACEHOLDER = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+    def __init__(self, body: dict[str, Any], pools: dict[str, ParameterPool], batch_size: int = TEMPLATE_BATCH_SIZE):
+        self.body = body
+        self.pools = pools
+        self.batch_size = batch_size
+        self.rng = random.Random()
+        self.prepare: Callable[[dict[str, Any]], Any] | None = None
+        self._bodies: list[Any] = []
+        self._next_bodies: concurrent.futures.Future[list[Any]] | None = None
+        self._executor: concurrent.futures.ThreadPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict[str, Any]:
+        return {k: v for k, v in self.__dict__.items() if k not in ("_next_bodies", "_executor", "_lock")}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        # Every worker process draws its own values
+        self.__dict__.update(state, rng=random.Random(), _bodies=[], _next_bodies=None, _executor=None,
+                             _lock=threading.Lock())
+
+    def next_body(self) -> Any:
+        with self._lock:
+            if not self._bodies:
+                if self._next_bodies is None:
+                    self._bodies = self.render_batch()
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix="esprober-template")
+                else:
+                    self._bodies = self._next_bodies.result()
+                self._next_bodies = self._executor.submit(self.render_batch)
+            return self._bodies.pop()
+
+    def render_batch(self) -> list[Any]:
+        bodies = [self.render() for _ in range(self.batch_size)]
+        if self.prepare is not None:
+            bodies = [self.prepare(b) for b in bodies]
+        return bodies
+
+    def render(self) -> dict[str, Any]:
+        values = {name: pool.draw(self.rng) for name, pool in self.pools.items()}
+        return self._render(self.body, values)
+
+    def _render(self, obj: Any, values: dict[str, Any]) -> Any:
+        if isinstance(obj, str):
+            match = self.PLACEHOLDER.fullmatch(obj)
+            if match is not None:
+                return values[match.group(1)]
+            return self.PLACEHOLDER.sub(lambda m: str(values[m.group(1)]), obj)
+        if isinstance(obj, dict):
+            return {self._render(k, values): self._render(v, values) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [self._render(v, values) for v in obj]
+        return obj
+
+
+class Schedule:
+    """Deadlines (monotonic times) planned every interval seconds since start time plus phase.
+
+    Every deadline is randomly delayed by up to jitter seconds. Deadlines don't depend on when previous
+    requests were actually sent, so they don't drift, and the delay requests are sent with after their
+    deadline is reported as schedule lag.
+    """
+
+    def __init__(self, interval: float, phase: float = 0., jitter: float = 0., start_time: float | None = None):
+        self.interval = interval
+        self.jitter = jitter
+        self.start_time = (time.monotonic() if start_time is None else start_time) + phase
+        self.count = 0
+        self.rng = random.Random()
+
+    def next(self, skip_missed: bool = False) -> float:
+        """It returns next deadline, skipping all missed deadlines but the last one when skip_missed is true."""
+        if skip_missed and self.interval > 0.:
+            missed = math.floor((time.monotonic() - self.start_time) / self.interval)
+            self.count = max(self.count, missed)
+        elif skip_missed:
+            # Requests are sent back to back
+            self.start_time = max(self.start_time, time.monotonic())
+        deadline = self.start_time + self.count * self.interval
+        self.count += 1
+        if self.jitter > 0.:
+            deadline += self.rng.uniform(0., self.jitter)
+        return deadline
+
+
+class TokenBucket:
+    """Rate limiter letting up to rate requests per second through, and up to burst of them at once.
+
+    Every request reserves a token, being told the (monotonic) time it can be sent at. Tokens are accounted
+    from the elapsed time, so waiting times don't accumulate sleep overshoots. It can be shared by threads.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.update_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __reduce__(self) -> tuple[type, tuple[float, int]]:
+        # Every worker process has its own bucket
+        return TokenBucket, (self.rate, self.burst)
+
+    def reserve(self) -> float:
+        """It takes a token, returning the monotonic time it becomes available at."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(float(self.burst), self.tokens + (now - self.update_time) * self.rate) - 1.
+            self.update_time = now
+            if self.tokens >= 0.:
+                return now
+            return now - self.tokens / self.rate
+
+    async def acquire(self) -> float:
+        """It waits for a token, returning the monotonic time it became available at."""
+        available_time = self.reserve()
+        delay = available_time - time.monotonic()
+        if delay > 0.:
+            await asyncio.sleep(delay)
+        return available_time
+
+    def wait(self, stopped: threading.Event) -> bool:
+        """It waits for a token unless stopped, returning False when stopped."""
+        delay = self.reserve() - time.monotonic()
+        if delay > 0.:
+            return not stopped.wait(delay)
+        return not stopped.is_set()
 
 
 @dataclasses.dataclass
@@ -49,133 +545,2241 @@ class QueryResult:
     timestamp: str
     name: str
     duration: float
+    # Server side execution time in seconds (from 'took' response field)
+    took: float | None = None
+    timed_out: bool | None = None
+    shards_total: int | None = None
+    shards_successful: int | None = None
+    shards_skipped: int | None = None
+    shards_failed: int | None = None
+    hits: int | None = None
+    response_bytes: int | None = None
+    # Request phases durations in seconds (see RequestTimings)
+    connect_time: float | None = None
+    tls_time: float | None = None
+    ttfb: float | None = None
+    download_time: float | None = None
+    decode_time: float | None = None
+    # Delay (in seconds) the request was sent with after its scheduled time (see Schedule)
+    schedule_lag: float | None = None
+    # Warm-up results are excluded from statistics
+    warmup: bool = False
+    cluster: str | None = None
+
+    @property
+    def key(self) -> str:
+        return query_key(self.name, self.cluster)
+
+    @classmethod
+    def from_response(
+        cls,
+        response: elastic_transport.ObjectApiResponse,
+        timings: 'RequestTimings | None' = None,
+        **kwargs: Any
+    ) -> 'QueryResult':
+        """It creates a result with the statistics reported by a search response and its request timings."""
+        if timings is None:
+            timings = RequestTimings()
+        content_length = response.meta.headers.get("content-length")
+        return cls.from_body(
+            response.body,
+            response_bytes=timings.response_bytes if content_length is None else int(content_length),
+            connect_time=timings.connect_time,
+            tls_time=timings.tls_time,
+            ttfb=timings.ttfb,
+            download_time=timings.download_time,
+            decode_time=timings.decode_time,
+            **kwargs
+        )
+
+    @classmethod
+    def from_body(cls, body: dict[str, Any], **kwargs: Any) -> 'QueryResult':
+        """It creates a result with the statistics reported by a search response body (or _msearch item)."""
+        took = body.get("took")
+        shards = body.get("_shards", {})
+        hits = body.get("hits", {}).get("total")
+        if isinstance(hits, dict):
+            hits = hits.get("value")
+        return cls(
+            took=None if took is None else took / 1000.,
+            timed_out=body.get("timed_out"),
+            shards_total=shards.get("total"),
+            shards_successful=shards.get("successful"),
+            shards_skipped=shards.get("skipped"),
+            shards_failed=shards.get("failed"),
+            hits=hits,
+            **kwargs
+        )
+
+    @classmethod
+    def from_row(cls, row: dict[str, Any]) -> 'QueryResult':
+        """It creates a result from a row of values, converting them to field types.
+
+        Missing values and empty strings are converted to None or to field default value.
+        """
+        kwargs: dict[str, Any] = {}
+        for name, type_ in _field_types(cls).items():
+            value = row.get(name)
+            if value is None or value == "":
+                continue
+            if type_ is bool and isinstance(value, str):
+                kwargs[name] = value == "True"
+            else:
+                kwargs[name] = type_(value)
+        return cls(**kwargs)
+
+
+@functools.cache
+def _field_types(cls: type) -> dict[str, type]:
+    # It strips None from optional types (like 'float | None')
+    return {
+        name: next(t for t in typing.get_args(type_) or [type_] if t is not type(None))
+        for name, type_ in typing.get_type_hints(cls).items()
+    }
+
+
+class Histogram:
+    """HDR-style histogram of durations (in seconds) with fixed memory footprint.
+
+    Durations are recorded in O(1) time with a relative precision given by the number of significant
+    digits, from one microsecond up to the highest trackable duration (bigger durations are clamped).
+    Histograms having the same layout can be merged together.
+    """
+
+    UNIT: float = 1e-6  # seconds
+
+    def __init__(self, highest: float = 3600., significant_digits: int = 2):
+        self.highest = highest
+        self.significant_digits = significant_digits
+        # Every bucket is made of two halves of sub-buckets. Sub-buckets of the same bucket have the same
+        # size, which doubles from a bucket to the next one.
+        self._sub_bucket_half_count_magnitude = math.ceil(math.log2(2 * 10 ** significant_digits)) - 1
+        self._sub_bucket_half_count = 1 << self._sub_bucket_half_count_magnitude
+        self._sub_bucket_mask = (self._sub_bucket_half_count << 1) - 1
+        self._highest_units = max(1, int(highest / self.UNIT))
+        bucket_count = 1
+        smallest_untrackable = self._sub_bucket_half_count << 1
+        while smallest_untrackable <= self._highest_units:
+            smallest_untrackable <<= 1
+            bucket_count += 1
+        self.counts = array.array("Q", bytes(8 * (bucket_count + 1) * self._sub_bucket_half_count))
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, duration: float) -> None:
+        value = min(max(0, int(duration / self.UNIT)), self._highest_units)
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def merge(self, other: 'Histogram') -> None:
+        if len(self.counts) != len(other.counts):
+            raise ValueError("Can't merge histograms with different layouts.")
+        for i, c in enumerate(other.counts):
+            if c:
+                self.counts[i] += c
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def subtract(self, other: 'Histogram') -> None:
+        """It removes the durations of a histogram merged before, but for the maximum which is left unchanged."""
+        if len(self.counts) != len(other.counts):
+            raise ValueError("Can't subtract histograms with different layouts.")
+        for i, c in enumerate(other.counts):
+            if c:
+                self.counts[i] -= c
+        self.count -= other.count
+        self.total = self.total - other.total if self.count else 0.
+
+    def copy(self) -> 'Histogram':
+        h = Histogram(highest=self.highest, significant_digits=self.significant_digits)
+        h.counts = self.counts[:]
+        h.count = self.count
+        h.total = self.total
+        h.max = self.max
+        return h
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "highest": self.highest,
+            "significant_digits": self.significant_digits,
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+            # Only non-empty counts are stored as [index, count] pairs
+            "counts": [[i, c] for i, c in enumerate(self.counts) if c],
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict[str, Any]) -> 'Histogram':
+        h = cls(highest=d["highest"], significant_digits=d["significant_digits"])
+        for i, c in d["counts"]:
+            h.counts[i] = c
+        h.count = d["count"]
+        h.total = d["total"]
+        h.max = d["max"]
+        return h
+
+    @property
+    def mean(self) -> float:
+        if not self.count:
+            return 0.
+        return self.total / self.count
+
+    def percentiles(self, *percentiles: float) -> list[float]:
+        """It returns the durations below which given percentages of recorded durations fall."""
+        results = [0.] * len(percentiles)
+        if not self.count:
+            return results
+        targets = sorted((max(1, math.ceil(p / 100. * self.count)), i) for i, p in enumerate(percentiles))
+        cumulative = 0
+        t = 0
+        for index, c in enumerate(self.counts):
+            if not c:
+                continue
+            cumulative += c
+            while t < len(targets) and targets[t][0] <= cumulative:
+                # Never report more than the exact recorded maximum
+                results[targets[t][1]] = min(self._highest_equivalent(index) * self.UNIT, self.max)
+                t += 1
+            if t == len(targets):
+                break
+        return results
+
+    def _index(self, value: int) -> int:
+        bucket = (value | self._sub_bucket_mask).bit_length() - (self._sub_bucket_half_count_magnitude + 1)
+        sub_bucket = value >> bucket
+        return ((bucket + 1) << self._sub_bucket_half_count_magnitude) + sub_bucket - self._sub_bucket_half_count
+
+    def _highest_equivalent(self, index: int) -> int:
+        bucket = max(0, (index >> self._sub_bucket_half_count_magnitude) - 1)
+        sub_bucket = index - (bucket << self._sub_bucket_half_count_magnitude)
+        return ((sub_bucket + 1) << bucket) - 1
+
+
+@dataclasses.dataclass
+class Summary:
+    """Aggregated results read from a results file up to a given offset.
+
+    It is check-pointed to a sidecar file so that at startup only results appended after the last
+    checkpoint have to be read again.
+    """
+    filename: str
+    offset: int = 0
+    histograms: dict[str, Histogram] = dataclasses.field(default_factory=dict)
+    save_time: float = dataclasses.field(default=0., repr=False)
+
+    def histogram(self, name: str) -> Histogram:
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        return h
+
+    def record(self, result: 'QueryResult') -> Histogram:
+        h = self.histogram(result.key)
+        h.record(result.duration)
+        return h
+
+    def commit(self, results: Sequence['QueryResult'], offset: int) -> None:
+        """It records results just written to the results store, which is now offset long."""
+        histograms = {r.key: self.record(r) for r in results if not r.warmup}
+        for name, h in histograms.items():
+            log_latency(name, h)
+        self.checkpoint(offset)
+
+    def checkpoint(self, offset: int, interval: float = SUMMARY_INTERVAL) -> None:
+        """It marks results up to offset as recorded, saving the summary when interval seconds are elapsed."""
+        self.offset = offset
+        if time.monotonic() - self.save_time >= interval:
+            self.save()
+
+    def save(self) -> None:
+        LOG.debug("Saving summary to '%s' (offset: %d).", self.filename, self.offset)
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump({
+                "offset": self.offset,
+                "histograms": {name: h.to_dict() for name, h in self.histograms.items()},
+            }, f)
+        os.replace(tmp_filename, self.filename)
+        self.save_time = time.monotonic()
+
+    @classmethod
+    def load(cls, filename: str) -> 'Summary':
+        if not os.path.isfile(filename):
+            return cls(filename=filename)
+        LOG.debug("Loading summary from '%s'.", filename)
+        try:
+            with open(filename) as f:
+                d = json.load(f)
+            return cls(
+                filename=filename,
+                offset=d["offset"],
+                histograms={name: Histogram.from_dict(h) for name, h in d["histograms"].items()},
+            )
+        except Exception as ex:
+            LOG.warning("Ignoring invalid summary file '%s': %s", filename, ex)
+            return cls(filename=filename)
+
+
+class RollingWindow:
+    """Latency histogram of the last duration seconds.
+
+    The window is a ring of slots histograms, each one covering duration / slots seconds, and a histogram of
+    their total: recording a value updates the current slot and the total, while expired slots are subtracted
+    from the total, so reading the window doesn't merge its slots. Slots are allocated lazily.
+    """
+
+    def __init__(self, duration: float, slots: int = 10):
+        self.duration = duration
+        self.slot_duration = duration / slots
+        self.slots: list[Histogram | None] = [None] * slots
+        self.slot = 0
+        self.total = Histogram()
+
+    @property
+    def name(self) -> str:
+        for unit, seconds in (("h", 3600), ("m", 60)):
+            if self.duration >= seconds and self.duration % seconds == 0:
+                return f"{int(self.duration // seconds)}{unit}"
+        return f"{self.duration:g}s"
+
+    def record(self, value: float, now: float | None = None) -> None:
+        i = self._rotate(now)
+        h = self.slots[i]
+        if h is None:
+            h = self.slots[i] = Histogram()
+        h.record(value)
+        self.total.record(value)
+
+    def histogram(self, now: float | None = None) -> Histogram:
+        """It returns a copy of the histogram of the window."""
+        self._rotate(now)
+        return self.total.copy()
+
+    def _rotate(self, now: float | None) -> int:
+        """It clears the slots expired since last rotation, returning the index of the current slot."""
+        slot = int((time.monotonic() if now is None else now) // self.slot_duration)
+        expired_any = False
+        for expired in range(max(self.slot + 1, slot - len(self.slots) + 1), slot + 1):
+            h = self.slots[expired % len(self.slots)]
+            if h is not None:
+                self.total.subtract(h)
+                self.slots[expired % len(self.slots)] = None
+                expired_any = True
+        if expired_any:
+            self.total.max = max((h.max for h in self.slots if h is not None), default=0.)
+        self.slot = max(self.slot, slot)
+        return self.slot % len(self.slots)
+
+
+class RollingStats:
+    """Live latency statistics of a query: sliding windows histograms and exponentially weighted moving average."""
+
+    def __init__(self, windows: Sequence[float] = ROLLING_WINDOWS, alpha: float = EWMA_ALPHA):
+        self.windows = [RollingWindow(w) for w in windows]
+        self.alpha = alpha
+        self.ewma: float | None = None
+
+    def record(self, value: float, now: float | None = None) -> None:
+        if now is None:
+            now = time.monotonic()
+        for w in self.windows:
+            w.record(value, now)
+        self.ewma = value if self.ewma is None else self.ewma + self.alpha * (value - self.ewma)
+
+
+class LiveStats:
+    """Rolling statistics of every query, updated as results arrive. It can be shared by threads."""
+
+    def __init__(self, windows: Sequence[float] = ROLLING_WINDOWS, alpha: float = EWMA_ALPHA):
+        self.windows = windows
+        self.alpha = alpha
+        self.stats: dict[str, RollingStats] = {}
+        self.lock = threading.Lock()
+
+    def record(self, result: 'QueryResult') -> None:
+        if result.warmup:
+            return
+        with self.lock:
+            stats = self.stats.get(result.key)
+            if stats is None:
+                stats = self.stats[result.key] = RollingStats(windows=self.windows, alpha=self.alpha)
+            stats.record(result.duration)
+
+    def observe(self, results: Iterable['QueryResult']) -> Iterator['QueryResult']:
+        """It records results passing through."""
+        for r in results:
+            self.record(r)
+            yield r
+
+    def keys(self) -> list[str]:
+        with self.lock:
+            return list(self.stats)
+
+    def windows_histograms(self, key: str) -> tuple[float | None, dict[str, Histogram]]:
+        """It returns the EWMA latency of a query and the histogram of every window by window name."""
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                return None, {}
+            return stats.ewma, {w.name: w.histogram() for w in stats.windows}
+
+    def log(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            ewma, histograms = self.windows_histograms(key)
+            if ewma is None:
+                continue
+            windows = []
+            for name, h in histograms.items():
+                p50, p90, p99 = h.percentiles(50., 90., 99.)
+                windows.append(f"{name}(n={h.count} mean={h.mean:f} p50={p50:f} p90={p90:f} p99={p99:f} max={h.max:f})")
+            LOG.info("Query '%s' rolling latency: ewma=%f %s seconds", key, ewma, " ".join(windows))
+
+
+class PrometheusHistogram:
+    """Histogram with the cumulative buckets of Prometheus exposition format."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # The last count is the one of +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name: str, labels: str) -> Iterator[str]:
+        cumulative = 0
+        for le, count in zip([f"{b:g}" for b in self.buckets] + ["+Inf"], list(self.counts)):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{le}"}} {cumulative}'
+        yield f"{name}_sum{{{labels}}} {self.sum!r}"
+        yield f"{name}_count{{{labels}}} {cumulative}"
+
+
+class Metrics:
+    """Prometheus metrics of the queries being probed.
+
+    Histograms are updated by the thread consuming results, while request counters are updated by engine
+    threads, each one having entries of its own: no lock is taken on the hot path. Metrics are copied when
+    scraped, so a scrape could see them slightly inconsistent. Request counters of worker processes are not
+    visible to the coordinator process.
+    """
+
+    BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120.)
+
+    def __init__(self, buckets: Sequence[float] = BUCKETS):
+        self.buckets = buckets
+        self.durations: dict[str, PrometheusHistogram] = {}
+        self.lags: dict[str, PrometheusHistogram] = {}
+        # Counters by (query key, thread identifier)
+        self.started: dict[tuple[str, int], int] = {}
+        self.finished: dict[tuple[str, int], int] = {}
+        self.failed: dict[tuple[str, int], int] = {}
+
+    def observe(self, results: Iterable['QueryResult']) -> Iterator['QueryResult']:
+        """It records results passing through."""
+        for r in results:
+            if not r.warmup:
+                self._histogram(self.durations, r.key).observe(r.duration)
+                if r.schedule_lag is not None:
+                    self._histogram(self.lags, r.key).observe(max(0., r.schedule_lag))
+            yield r
+
+    def request_started(self, key: str) -> None:
+        self._increment(self.started, key)
+
+    def request_finished(self, key: str) -> None:
+        self._increment(self.finished, key)
+
+    def request_failed(self, key: str) -> None:
+        self._increment(self.failed, key)
+
+    def render(self, live: 'LiveStats | None' = None) -> str:
+        """It returns metrics in Prometheus text exposition format."""
+        lines: list[str] = []
+        lines += self._render_histograms("esprober_request_duration_seconds", self.durations,
+                                         "Duration of probe requests in seconds.")
+        lines += self._render_histograms("esprober_schedule_lag_seconds", self.lags,
+                                         "Delay of probe requests after their scheduled time in seconds.")
+        started, finished, failed = (self._sum(c) for c in (self.started, self.finished, self.failed))
+        lines += ["# HELP esprober_requests_in_flight Probe requests waiting for their responses.",
+                  "# TYPE esprober_requests_in_flight gauge"]
+        lines += [f"esprober_requests_in_flight{{{self._labels(k)}}} {n - finished.get(k, 0)}"
+                  for k, n in sorted(started.items())]
+        lines += ["# HELP esprober_request_errors_total Probe requests failed.",
+                  "# TYPE esprober_request_errors_total counter"]
+        lines += [f"esprober_request_errors_total{{{self._labels(k)}}} {n}" for k, n in sorted(failed.items())]
+        if live is not None:
+            lines += self._render_live(live)
+        return "\n".join(lines) + "\n"
+
+    def _render_histograms(self, name: str, histograms: dict[str, PrometheusHistogram], help: str) -> list[str]:
+        lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+        for key, h in sorted(histograms.copy().items()):
+            lines += h.render(name, self._labels(key))
+        return lines
+
+    @classmethod
+    def _render_live(cls, live: 'LiveStats') -> list[str]:
+        ewma_lines = ["# HELP esprober_latency_ewma_seconds Exponentially weighted moving average of latency.",
+                      "# TYPE esprober_latency_ewma_seconds gauge"]
+        window_lines = ["# HELP esprober_latency_window_seconds Latency quantiles over sliding windows.",
+                        "# TYPE esprober_latency_window_seconds gauge"]
+        for key in sorted(live.keys()):
+            ewma, histograms = live.windows_histograms(key)
+            if ewma is None:
+                continue
+            labels = cls._labels(key)
+            ewma_lines.append(f"esprober_latency_ewma_seconds{{{labels}}} {ewma!r}")
+            for window, h in histograms.items():
+                for q, value in zip(("0.5", "0.9", "0.99", "1"), h.percentiles(50., 90., 99., 100.)):
+                    window_lines.append(
+                        f'esprober_latency_window_seconds{{{labels},window="{window}",quantile="{q}"}} {value!r}')
+        return ewma_lines + window_lines
+
+    def _histogram(self, histograms: dict[str, PrometheusHistogram], key: str) -> PrometheusHistogram:
+        h = histograms.get(key)
+        if h is None:
+            h = histograms[key] = PrometheusHistogram(self.buckets)
+        return h
+
+    @staticmethod
+    def _increment(counters: dict[tuple[str, int], int], key: str) -> None:
+        # Only the current thread updates its own entries
+        k = (key, threading.get_ident())
+        counters[k] = counters.get(k, 0) + 1
+
+    @staticmethod
+    def _sum(counters: dict[tuple[str, int], int]) -> dict[str, int]:
+        sums: dict[str, int] = {}
+        for (key, _), n in list(counters.items()):
+            sums[key] = sums.get(key, 0) + n
+        return sums
+
+    @staticmethod
+    def _labels(key: str) -> str:
+        value = key.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return f'query="{value}"'
+
+
+METRICS = Metrics()
+
+
+class ResultsStore(abc.ABC):
+    """Append-only storage of query results.
+
+    Offsets are opaque store positions (as returned by size method) results can be read from.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+
+    @abc.abstractmethod
+    def size(self) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read(self, offset: int = 0) -> Iterator[QueryResult]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def writer(self) -> typing.ContextManager[Callable[[Sequence[QueryResult]], int]]:
+        """It opens the store for appending results, returning a function writing a batch of results.
+
+        The write function makes given results durable and returns the new size of the store.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def arrays(self) -> dict[str, 'numpy.ndarray']:
+        """It loads every column of the store as a NumPy array (see ColumnarResultsStore.arrays)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def dictionary(self, column: str) -> list[str]:
+        """It returns the strings the codes of a dictionary encoded column returned by arrays method index."""
+        raise NotImplementedError
+
+
+class CSVResultsStore(ResultsStore):
+
+    BLOCK_SIZE = 65536  # rows
+
+    def __init__(self, filename: str):
+        super().__init__(filename)
+        self._dictionaries: dict[str, list[str]] = {}
+
+    def size(self) -> int:
+        if not os.path.isfile(self.filename):
+            return 0
+        return os.path.getsize(self.filename)
+
+    def read(self, offset: int = 0) -> Iterator[QueryResult]:
+        if not os.path.isfile(self.filename):
+            return
+        LOG.debug("Reading results from '%s' (offset: %d).", self.filename, offset)
+        try:
+            with open(self.filename, "r", newline="") as csv_file:
+                fieldnames = None
+                if offset > 0:
+                    # Read the header before skipping already read rows
+                    fieldnames = next(csv.reader([csv_file.readline()]))
+                    csv_file.seek(offset)
+                for row in csv.DictReader(csv_file, fieldnames=fieldnames):
+                    yield QueryResult.from_row(row)
+        finally:
+            LOG.debug("Terminated reading results from '%s'.", self.filename)
+
+    @contextlib.contextmanager
+    def writer(self) -> Iterator[Callable[[Sequence[QueryResult]], int]]:
+        out_dir = os.path.dirname(self.filename)
+        if out_dir and not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        fieldnames = [f.name for f in dataclasses.fields(QueryResult)]
+        write_header = not os.path.isfile(self.filename) or os.path.getsize(self.filename) == 0
+        if not write_header:
+            with open(self.filename, "r", newline="") as fd:
+                header = next(csv.reader([fd.readline()]))
+            if header != fieldnames:
+                LOG.warning("Results file '%s' has different columns: only columns %r are going to be written.",
+                            self.filename, header)
+                fieldnames = header
+        # Warm-up results couldn't be told apart without their flag
+        keep_warmup = "warmup" in fieldnames
+        with open(self.filename, "a", newline="") as fd:
+            writer = csv.DictWriter(fd, fieldnames=fieldnames, extrasaction="ignore")
+            if write_header:
+                LOG.debug("Writing header to '%s'...", self.filename)
+                writer.writeheader()
+
+            def write(results: Sequence[QueryResult]) -> int:
+                writer.writerows(dataclasses.asdict(r) for r in results if keep_warmup or not r.warmup)
+                fd.flush()
+                return os.fstat(fd.fileno()).st_size
+
+            yield write
+
+    def arrays(self) -> dict[str, 'numpy.ndarray']:
+        """It loads every column of the store as a NumPy array, with the same types as ColumnarResultsStore."""
+        if numpy is None:
+            raise RuntimeError("NumPy is required for loading results arrays: please install 'esprober[numpy]'.")
+        typecodes = {name: _column_typecode(name, type_) for name, type_ in _field_types(QueryResult).items()}
+        dictionaries: dict[str, dict[str, int]] = {c: {} for c, t in typecodes.items() if t == "i"}
+        blocks: dict[str, list[numpy.ndarray]] = {c: [] for c in typecodes}
+        if os.path.isfile(self.filename):
+            with open(self.filename, "r", newline="") as csv_file:
+                reader = csv.reader(csv_file)
+                header = next(reader, [])
+                # Rows are converted a block at a time, so that only the arrays are kept in memory
+                for block in iter(lambda: list(itertools.islice(reader, self.BLOCK_SIZE)), []):
+                    # Skip a partially written last row
+                    rows = [row for row in block if len(row) == len(header)]
+                    for c, t in typecodes.items():
+                        i = header.index(c) if c in header else None
+                        blocks[c].append(self._parse_column(rows, i, t, dictionaries.get(c)))
+        self._dictionaries = {c: list(d) for c, d in dictionaries.items()}
+        arrays: dict[str, numpy.ndarray] = {}
+        for c, t in typecodes.items():
+            dtype = "datetime64[ns]" if t == "q" else _NUMPY_DTYPES[t]
+            arrays[c] = numpy.concatenate(blocks[c]) if blocks[c] else numpy.empty(0, dtype=dtype)
+        return arrays
+
+    @staticmethod
+    def _parse_column(rows: list[list[str]], index: int | None, typecode: str,
+                      dictionary: dict[str, int] | None) -> 'numpy.ndarray':
+        """It converts the field at index of given rows (empty fields when None) to an array of typecode values."""
+        strings: Iterable[str] = itertools.repeat("", len(rows)) if index is None else (row[index] for row in rows)
+        dtype = _NUMPY_DTYPES[typecode]
+        if typecode == "q":
+            return numpy.array([s or "NaT" for s in strings], dtype="datetime64[ns]")
+        if typecode == "i":
+            assert dictionary is not None
+            values: Iterable[Any] = (dictionary.setdefault(s, len(dictionary)) if s else -1 for s in strings)
+        elif typecode == "B":
+            values = (1 if s == "True" else 0 if s == "False" else 255 for s in strings)
+        else:
+            values = (float(s) if s else math.nan for s in strings)
+        return numpy.fromiter(values, dtype=dtype, count=len(rows))
+
+    def dictionary(self, column: str) -> list[str]:
+        return self._dictionaries.get(column, [])
+
+
+class ColumnarResultsStore(ResultsStore):
+    """Append-only columnar binary store of query results.
+
+    The store is a directory having a little-endian binary file for every column of the results:
+    - timestamps are stored as int64 nanoseconds since the epoch;
+    - strings are dictionary encoded as int32 codes (-1 for None) with the dictionary stored in a
+      '<column>.dict' file having a JSON string per line;
+    - booleans are stored as uint8 (255 for None);
+    - other numbers are stored as float64 (NaN for None).
+    Offsets are row numbers.
+    """
+
+    BLOCK_SIZE = 65536  # rows
+
+    def __init__(self, filename: str):
+        super().__init__(filename)
+        self.columns: dict[str, str] = {
+            name: _column_typecode(name, type_) for name, type_ in _field_types(QueryResult).items()
+        }
+
+    def column_filename(self, column: str) -> str:
+        return os.path.join(self.filename, f"{column}.bin")
+
+    def dictionary_filename(self, column: str) -> str:
+        return os.path.join(self.filename, f"{column}.dict")
+
+    def size(self) -> int:
+        # A column could have been partially written when the prober was interrupted
+        sizes = [self._column_size(c) for c in self.columns if os.path.isfile(self.column_filename(c))]
+        return min(sizes, default=0)
+
+    def read(self, offset: int = 0) -> Iterator[QueryResult]:
+        size = self.size()
+        if offset >= size:
+            return
+        LOG.debug("Reading results from '%s' (offset: %d).", self.filename, offset)
+        try:
+            dictionaries = {c: self._read_dictionary(c) for c, t in self.columns.items() if t == "i"}
+            for start in range(offset, size, self.BLOCK_SIZE):
+                count = min(self.BLOCK_SIZE, size - start)
+                columns = {c: self._read_column(c, start, count) for c in self.columns}
+                for i in range(count):
+                    yield QueryResult.from_row({
+                        c: self._decode(c, values[i], dictionaries.get(c)) for c, values in columns.items()
+                    })
+        finally:
+            LOG.debug("Terminated reading results from '%s'.", self.filename)
+
+    @contextlib.contextmanager
+    def writer(self) -> Iterator[Callable[[Sequence[QueryResult]], int]]:
+        os.makedirs(self.filename, exist_ok=True)
+        size = self.size()
+        dictionaries = {c: {v: i for i, v in enumerate(self._read_dictionary(c))}
+                        for c, t in self.columns.items() if t == "i"}
+        with contextlib.ExitStack() as stack:
+            files = {c: stack.enter_context(open(self.column_filename(c), "ab")) for c in self.columns}
+            dictionary_files = {c: stack.enter_context(open(self.dictionary_filename(c), "a")) for c in dictionaries}
+            for c, f in files.items():
+                # Drop partially written rows and fill columns which were missing when previous rows were written
+                f.truncate(min(f.tell(), size * array.array(self.columns[c]).itemsize))
+                missing = size - self._column_size(c)
+                if missing > 0:
+                    self._write_column(f, c, [self._fill_value(c)] * missing)
+            for c, f in dictionary_files.items():
+                # Drop a partially written last string
+                f.truncate(self._dictionary_size(c))
+
+            def write(results: Sequence[QueryResult]) -> int:
+                nonlocal size
+                for c, f in files.items():
+                    values = [getattr(r, c) for r in results]
+                    if c in dictionaries:
+                        values = [self._encode_string(v, dictionaries[c], dictionary_files[c]) for v in values]
+                    self._write_column(f, c, values)
+                for f in dictionary_files.values():
+                    f.flush()
+                for f in files.values():
+                    f.flush()
+                size += len(results)
+                return size
+
+            yield write
+
+    def arrays(self) -> dict[str, 'numpy.ndarray']:
+        """It memory-maps every column of the store as a NumPy array.
+
+        Timestamps are returned as datetime64[ns] values, while dictionary encoded strings are returned as
+        codes indexing the list returned by dictionary method.
+        """
+        if numpy is None:
+            raise RuntimeError("NumPy is required for loading results arrays: please install 'esprober[numpy]'.")
+        size = self.size()
+        arrays: dict[str, numpy.ndarray] = {}
+        for c, t in self.columns.items():
+            dtype = numpy.dtype(_NUMPY_DTYPES[t])
+            if size == 0:
+                arrays[c] = numpy.empty(0, dtype=dtype)
+            else:
+                arrays[c] = numpy.memmap(self.column_filename(c), dtype=dtype, mode="r", shape=(size,))
+        if "timestamp" in arrays:
+            arrays["timestamp"] = arrays["timestamp"].view("datetime64[ns]")
+        return arrays
+
+    def dictionary(self, column: str) -> list[str]:
+        return self._read_dictionary(column)
+
+    def _column_size(self, column: str) -> int:
+        return os.path.getsize(self.column_filename(column)) // array.array(self.columns[column]).itemsize
+
+    def _read_column(self, column: str, offset: int, count: int) -> array.array:
+        values = array.array(self.columns[column])
+        with open(self.column_filename(column), "rb") as f:
+            f.seek(offset * values.itemsize)
+            values.fromfile(f, count)
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def _write_column(self, f: typing.BinaryIO, column: str, values: list[Any]) -> None:
+        if column == "timestamp":
+            values = [_timestamp_to_ns(v) for v in values]
+        elif self.columns[column] == "d":
+            values = [math.nan if v is None else v for v in values]
+        elif self.columns[column] == "B":
+            values = [255 if v is None else v for v in values]
+        values = array.array(self.columns[column], values)
+        if sys.byteorder == "big":
+            values.byteswap()
+        values.tofile(f)
+
+    def _read_dictionary(self, column: str) -> list[str]:
+        filename = self.dictionary_filename(column)
+        if not os.path.isfile(filename):
+            return []
+        with open(filename) as f:
+            # A partially written last string has no newline
+            return [json.loads(line) for line in f if line.endswith("\n") and line.strip()]
+
+    def _dictionary_size(self, column: str) -> int:
+        """It returns the size of the dictionary file of a column up to its last complete string."""
+        filename = self.dictionary_filename(column)
+        if not os.path.isfile(filename):
+            return 0
+        with open(filename, "rb") as f:
+            return f.read().rfind(b"\n") + 1
+
+    @staticmethod
+    def _encode_string(value: str | None, dictionary: dict[str, int], f: typing.TextIO) -> int:
+        if value is None:
+            return -1
+        code = dictionary.get(value)
+        if code is None:
+            code = dictionary[value] = len(dictionary)
+            f.write(json.dumps(value) + "\n")
+        return code
+
+    def _decode(self, column: str, value: Any, dictionary: list[str] | None) -> Any:
+        if dictionary is not None:
+            return None if value < 0 else dictionary[value]
+        if column == "timestamp":
+            return _timestamp_from_ns(value)
+        if self.columns[column] == "d" and math.isnan(value):
+            return None
+        if self.columns[column] == "B" and value == 255:
+            return None
+        return value
+
+    def _fill_value(self, column: str) -> Any:
+        return {"q": 0, "i": -1, "B": None, "d": None}[self.columns[column]]
+
+
+RESULTS_STORES: dict[str, type[ResultsStore]] = {
+    "csv": CSVResultsStore,
+    "columnar": ColumnarResultsStore,
+}
+
+# It maps array type codes used by columnar results store to NumPy dtypes
+_NUMPY_DTYPES = {"q": "<i8", "i": "<i4", "B": "u1", "d": "<f8"}
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _column_typecode(name: str, type_: type) -> str:
+    if name == "timestamp":
+        return "q"
+    if type_ is str:
+        return "i"
+    if type_ is bool:
+        return "B"
+    return "d"
+
+
+def _timestamp_to_ns(timestamp: str) -> int:
+    dt = datetime.datetime.fromisoformat(timestamp).replace(tzinfo=datetime.timezone.utc)
+    return (dt - _EPOCH) // datetime.timedelta(microseconds=1) * 1000
+
+
+def _timestamp_from_ns(ns: int) -> str:
+    dt = _EPOCH + datetime.timedelta(microseconds=ns // 1000)
+    return datetime.datetime.strftime(dt, "%Y-%m-%dT%H:%M:%S.%f")[:-3]
+
+
+def results_store(filename: str = RESULTS_FILENAME, results_format: str = RESULTS_FORMAT) -> ResultsStore:
+    try:
+        return RESULTS_STORES[results_format](filename)
+    except KeyError:
+        raise ValueError(f"Unsupported results format: '{results_format}'.") from None
+
+
+def query_key(name: str, cluster: str | None) -> str:
+    """It returns the key identifying a query on a cluster, used for aggregating its results."""
+    if cluster is None:
+        return name
+    return f"{cluster}/{name}"
 
 
 def main(
     log_filename: str = LOG_FILENAME,
     queries_filename: str = QUERIES_FILENAME,
-    results_filename: str = RESULTS_FILENAME
+    results_filename: str = RESULTS_FILENAME,
+    summary_filename: str = SUMMARY_FILENAME,
+    clusters_filename: str = CLUSTERS_FILENAME,
 ) -> None:
     init_logging(log_filename)
 
-    queries = load_queries(queries_filename)
+    queries: list[Probe] = []
+    # Replayed requests come from their capture file
+    if ENGINE != "replay":
+        queries = load_queries(queries_filename, clusters=load_clusters(clusters_filename))
+    keys = result_keys(queries)
 
-    durations: dict[str, list[float]] = {q.name: [] for q in queries}
-    for result in read_results(results_filename):
-        durations[result.name].append(result.duration)
-    for q in queries:
-        LOG.info("Query '%s' average time: %f seconds", q.name, average(durations[q.name]))
+    store = results_store(results_filename)
+    summary = read_summary(store, summary_filename)
+    for key in keys:
+        log_latency(key, summary.histogram(key))
+    live = LiveStats()
+
+    def commit(results: Sequence[QueryResult], offset: int) -> None:
+        summary.commit(results, offset)
+        live.log(dict.fromkeys(r.key for r in results if not r.warmup))
+
+    # Make sure pending results are written when terminated by a signal
+    signal.signal(signal.SIGTERM, terminate)
+
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = start_metrics_server(METRICS, live=live)
 
     LOG.debug(f"Start sending queries...")
     try:
-        results = send_queries(queries=queries, durations=durations)
-        write_results(results_filename, results)
+        if PROCESSES > 1:
+            results = send_queries_multiprocess(queries=queries, log_filename=log_filename)
+        else:
+            results = ENGINES[ENGINE](queries=queries)
+        write_results(store, METRICS.observe(live.observe(results)), commit=commit)
     finally:
         LOG.debug(f"Terminated sending queries.")
-        for q in queries:
-            LOG.info("Query '%s' average time: %f seconds", q.name, average(durations[q.name]))
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        summary.save()
+        # Replayed requests have keys of their own
+        for key in keys + [k for k in summary.histograms if k not in keys]:
+            log_latency(key, summary.histogram(key))
+
+
+def cli(argv: Sequence[str] | None = None) -> None:
+    """Command line entry point: it probes queries when no command is given."""
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
+        main()
+        return
+
+    parser = argparse.ArgumentParser(prog="esprober", description="Prober for ElasticSearch queries latencies.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_import = commands.add_parser(
+        "import-slowlog", help="Generate queries from search slowlog files, ranked by frequency times cost.")
+    parser_import.add_argument("filenames", nargs="+", metavar="FILENAME",
+                               help="slowlog file (plain text or JSON lines, optionally gzipped)")
+    parser_import.add_argument("-o", "--output", default="-", help="queries file to write (default: stdout)")
+    parser_import.add_argument("-n", "--top", type=int, default=None, help="number of queries to emit")
+
+    parser_report = commands.add_parser("report", help="Compute latency statistics of stored results.")
+    parser_report.add_argument("--results", default=RESULTS_FILENAME, help="results file or directory")
+    parser_report.add_argument("--format", default=RESULTS_FORMAT, choices=sorted(RESULTS_STORES),
+                               help="results format")
+    parser_report.add_argument("--bucket", default=None, choices=sorted(TIME_BUCKETS),
+                               help="roll up statistics of every query per time bucket too")
+    parser_report.add_argument("--json", action="store_true", help="print the report as JSON")
+
+    args = parser.parse_args(argv)
+    if args.command == "import-slowlog":
+        import_slowlog_command(args.filenames, output=args.output, top=args.top)
+    elif args.command == "report":
+        report_command(results_store(args.results, args.format), bucket=args.bucket, as_json=args.json)
+
+
+def report_command(store: ResultsStore, bucket: str | None = None, as_json: bool = False) -> None:
+    report = results_report(store, bucket=bucket)
+    if as_json:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+    columns = ["count", "mean", "stddev", "p50", "p90", "p99", "max"]
+    for section, title in [("queries", "query"), ("buckets", "time")]:
+        if section not in report:
+            continue
+        print(f"{'query':<40} {'time' if section == 'buckets' else '':<20} " +
+              " ".join(f"{c:>10}" for c in columns))
+        for row in report[section]:
+            print(f"{row['key']:<40} {row.get('time', ''):<20} {row['count']:>10d} " +
+                  " ".join(f"{row[c]:>10.6f}" for c in columns[1:]))
+        print()
+
+
+# NumPy datetime units of report time buckets
+TIME_BUCKETS = {"minute": "m", "hour": "h"}
+
+
+def results_report(store: ResultsStore, bucket: str | None = None) -> dict[str, Any]:
+    """It computes latency statistics of every query, and of every query and time bucket (when bucket is given).
+
+    Statistics are computed by vectorized NumPy operations over the arrays of the store, excluding warm-up
+    results.
+    """
+    if numpy is None:
+        raise RuntimeError("NumPy is required for reporting results: please install 'esprober[numpy]'.")
+    arrays = store.arrays()
+    names, clusters = store.dictionary("name"), store.dictionary("cluster")
+    keep = arrays["warmup"] != 1
+    durations = arrays["duration"][keep]
+    # Codes of (name, cluster) pairs, being -1 the code of None cluster
+    pairs = arrays["name"][keep].astype(numpy.int64) * (len(clusters) + 1) + arrays["cluster"][keep] + 1
+    pair_values, codes = numpy.unique(pairs, return_inverse=True)
+    keys = [query_key(names[p // (len(clusters) + 1)], clusters[p % (len(clusters) + 1) - 1]
+                      if p % (len(clusters) + 1) else None) for p in pair_values.tolist()]
+
+    report: dict[str, Any] = {"queries": [{"key": keys[i], **stats}
+                                          for i, stats in enumerate(group_stats(codes, durations, len(keys)))]}
+    if bucket is not None:
+        times = arrays["timestamp"][keep].astype(f"datetime64[{TIME_BUCKETS[bucket]}]")
+        time_values, time_codes = numpy.unique(times, return_inverse=True)
+        group_values, group_codes = numpy.unique(codes * len(time_values) + time_codes, return_inverse=True)
+        report["buckets"] = [
+            {"key": keys[g // len(time_values)], "time": str(time_values[g % len(time_values)]), **stats}
+            for g, stats in zip(group_values.tolist(), group_stats(group_codes, durations, len(group_values)))
+        ]
+    return report
+
+
+def group_stats(codes: 'numpy.ndarray', values: 'numpy.ndarray', count: int) -> list[dict[str, Any]]:
+    """It computes the statistics of values of every group, being codes the group (in range(count)) of every value."""
+    counts = numpy.bincount(codes, minlength=count)
+    ends = numpy.cumsum(counts)
+    starts = ends - counts
+    # Values sorted by group and then by value, so that percentiles are picked by index: values are sorted, and
+    # then their positions are sorted by group (packed into the high bits), which is faster than numpy.lexsort
+    order = numpy.argsort(values)
+    bits = max(1, len(values).bit_length())
+    keys = (codes[order].astype(numpy.int64) << bits) | numpy.arange(len(values), dtype=numpy.int64)
+    keys.sort()
+    sorted_values = values[order[keys & ((1 << bits) - 1)]]
+    sizes = numpy.maximum(counts, 1)
+    means = numpy.bincount(codes, weights=values, minlength=count) / sizes
+    squares = numpy.bincount(codes, weights=values * values, minlength=count) / sizes
+    stats: dict[str, Any] = {
+        "count": counts,
+        "mean": means,
+        "stddev": numpy.sqrt(numpy.maximum(squares - means * means, 0.)),
+    }
+    for p in (50., 90., 99.):
+        ranks = numpy.maximum(numpy.ceil(counts * p / 100.).astype(numpy.int64) - 1, 0)
+        stats[f"p{p:g}"] = sorted_values[numpy.minimum(starts + ranks, len(values) - 1)] if len(values) else means
+    stats["max"] = sorted_values[ends - 1] if len(values) else means
+    columns = {k: v.tolist() for k, v in stats.items()}
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+
+def import_slowlog_command(filenames: Sequence[str], output: str = "-", top: int | None = None) -> None:
+    shapes = import_slowlog(filenames)[:top]
+    queries = [{"name": shape.name, "path": shape.index, "body": shape.body} for shape in shapes]
+    for shape in shapes:
+        print(f"{shape.name}: count={shape.count} mean_took={shape.mean_took:f} max_took={shape.max_took:f} "
+              f"cost={shape.cost:f}", file=sys.stderr)
+    if output == "-":
+        json.dump(queries, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(output, "w") as f:
+            json.dump(queries, f, indent=2)
+
+
+def start_metrics_server(
+    metrics: Metrics,
+    live: LiveStats | None = None,
+    host: str = METRICS_HOST,
+    port: int = METRICS_PORT,
+) -> http.server.ThreadingHTTPServer:
+    """It serves metrics in Prometheus text format at '/metrics' path from a background thread."""
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self) -> None:
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render(live).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
 
+        def log_message(self, format: str, *args: Any) -> None:
+            LOG.debug("Metrics server: " + format, *args)
 
-def init_logging(filename: str = LOG_FILENAME) -> None:
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="esprober-metrics", daemon=True).start()
+    LOG.info("Serving metrics at http://%s:%d/metrics", host, server.server_address[1])
+    return server
+
+
+def init_logging(filename: str = LOG_FILENAME, level: str = LOG_LEVEL) -> None:
     logging.basicConfig(
         filename=filename,
         encoding='utf-8',
-        level=logging.DEBUG,
+        level=level,
         format='%(asctime)s %(levelname)-8s %(message)s',
         datefmt="%Y-%m-%d %H:%M:%S",
     )
+    # Transport logs a message for every request
+    logging.getLogger("elastic_transport").setLevel(logging.WARNING)
+
+
+def load_clusters(filename: str = CLUSTERS_FILENAME) -> list[Cluster]:
+    """It loads the clusters to be probed, or the cluster configured by environment when the file is missing."""
+    if not os.path.isfile(filename):
+        return [Cluster()]
+    LOG.debug("Loading clusters from '%s'.", filename)
+    try:
+        with open(filename) as f:
+            clusters = [Cluster(**{"api_key": None, **d}) for d in json.load(f)]
+        names = [c.name for c in clusters]
+        if not clusters or None in names or len(set(names)) != len(names):
+            raise ValueError(f"Clusters in '{filename}' must have distinct names.")
+        return clusters
+    finally:
+        LOG.debug("Terminated loading clusters from '%s'.", filename)
 
 
-def load_queries(filename: str) -> list[Query]:
+def load_queries(filename: str, clusters: list[Cluster] | None = None, msearch: bool = MSEARCH) -> list[Probe]:
+    """It loads queries, making a copy of every query for every cluster it has to be sent to.
+
+    When msearch is true, queries to the same cluster (and having the same rate) are grouped into multi searches.
+    """
     LOG.debug("Loading queries from '%s'.", filename)
     try:
         with open(filename) as f:
-            return [Query(**d) for d in json.load(f)]
+            queries = [Query(**d) for d in json.load(f)]
+        if clusters is not None:
+            queries = [dataclasses.replace(q, cluster=c)
+                       for q in queries for c in clusters
+                       if q.clusters is None or c.name in q.clusters]
+        probes: list[Probe] = list(queries)
+        if msearch:
+            groups: dict[tuple[Cluster, float | None], list[Query]] = {}
+            for q in queries:
+                groups.setdefault((q.cluster, q.rate), []).append(q)
+            probes = [MultiSearch(queries=group, rate=rate, name="_msearch" if rate is None else f"_msearch@{rate:g}")
+                      for (_, rate), group in groups.items()]
+        for p in probes:
+            if p.raw:
+                p.prepare()
+        return probes
     finally:
         LOG.debug("Terminated loading queries from '%s'.", filename)
 
 
+def result_keys(queries: Iterable[Probe]) -> list[str]:
+    """It returns the keys of the results produced by sending queries."""
+    return [k for q in queries for k in (q.keys if isinstance(q, MultiSearch) else [q.key])]
+
+
+def as_results(results: 'QueryResult | list[QueryResult]') -> list[QueryResult]:
+    """It returns the results produced by sending a query (a single one) or a multi search (a list)."""
+    if isinstance(results, list):
+        return results
+    return [results]
+
+
+def read_capture(filename: str = REPLAY_FILENAME, shard: tuple[int, int] = (0, 1)) -> Iterator[tuple[float, Query]]:
+    """It streams the search requests of a JSON lines capture, as (timestamp in seconds, query) pairs.
+
+    Every line has 'timestamp' (seconds since epoch or ISO 8601 string), 'path' (as '/<index>/_search') and
+    'body' fields. The request class the query is named after is the 'name' field, or the path when missing.
+    Lines not being search requests are skipped. Given (index, count) shard, only lines whose number modulo
+    count is index are read.
+    """
+    LOG.debug("Reading captured requests from '%s'.", filename)
+    shard_index, shard_count = shard
+    with open(filename) as f:
+        for number, line in enumerate(f, 1):
+            if (number - 1) % shard_count != shard_index or not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                timestamp = record["timestamp"]
+                if isinstance(timestamp, str):
+                    timestamp = datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp()
+                path = record["path"].split("?", 1)[0].strip("/")
+                index, _, endpoint = path.rpartition("/")
+                if endpoint != "_search":
+                    LOG.debug("Skipping request at '%s' line %d: '%s' is not a search path.", filename, number, path)
+                    continue
+                query = Query(name=record.get("name") or path, path=index, body=record.get("body") or {})
+            except (KeyError, TypeError, ValueError) as ex:
+                LOG.warning("Skipping invalid request at '%s' line %d: %s", filename, number, ex)
+                continue
+            yield float(timestamp), query
+
+
+@dataclasses.dataclass
+class QueryShape:
+    """Search requests to the same index having the same body once their values are normalized away."""
+    index: str
+    shape: str
+    # The body of the slowest request having this shape
+    body: dict[str, Any]
+    count: int = 0
+    # Total and maximum took of the requests (in seconds)
+    cost: float = 0.
+    max_took: float = 0.
+
+    @property
+    def name(self) -> str:
+        digest = hashlib.sha1(f"{self.index}\n{self.shape}".encode()).hexdigest()[:8]
+        return f"slowlog-{self.index or '_all'}-{digest}"
+
+    @property
+    def mean_took(self) -> float:
+        return self.cost / self.count if self.count else 0.
+
+    def add(self, took: float, body: dict[str, Any]) -> None:
+        self.count += 1
+        self.cost += took
+        if took >= self.max_took:
+            self.max_took = took
+            self.body = body
+
+
+def import_slowlog(filenames: Iterable[str]) -> list[QueryShape]:
+    """It deduplicates the requests of slowlog files by shape, ranking shapes by frequency times cost (total took)."""
+    shapes: dict[tuple[str, str], QueryShape] = {}
+    for filename in filenames:
+        for index, took, body in read_slowlog(filename):
+            shape = json.dumps(normalize_query(body), sort_keys=True)
+            key = (index, shape)
+            if key not in shapes:
+                shapes[key] = QueryShape(index=index, shape=shape, body=body)
+            shapes[key].add(took, body)
+    return sorted(shapes.values(), key=lambda s: s.cost, reverse=True)
+
+
+def normalize_query(obj: Any) -> Any:
+    """It replaces the values of a query body with placeholders, keeping its structure."""
+    if isinstance(obj, dict):
+        return {k: normalize_query(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        # Lists of values (like terms query ones) have the same shape regardless of their length
+        items = [normalize_query(v) for v in obj]
+        if all(v == "?" for v in items):
+            return ["?"] if items else []
+        return items
+    return "?"
+
+
+SLOWLOG_TEXT = re.compile(r"\]\s*\[(?P<index>[^\]\[]+)\]\[\d+\]\s*took\[[^\]]*\],\s*took_millis\[(?P<took>\d+)\]"
+                          r".*?source\[(?P<source>.*)\],\s*id\[")
+
+
+def read_slowlog(filename: str) -> Iterator[tuple[str, float, dict[str, Any]]]:
+    """It streams search slowlog entries as (index, took in seconds, request body) tuples.
+
+    Both plain text slowlogs and JSON lines ones (having fields with or without 'elasticsearch.slowlog.' prefix)
+    are supported. Entries whose source can't be decoded are skipped.
+    """
+    LOG.debug("Reading slowlog '%s'.", filename)
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rt", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            try:
+                if line.startswith("{"):
+                    entry = json.loads(line)
+
+                    def field(name: str) -> Any:
+                        return entry.get(f"elasticsearch.slowlog.{name}", entry.get(name))
+
+                    message, took, source = field("message"), field("took_millis"), field("source")
+                    if message is None or took is None or source is None:
+                        continue
+                    match = re.match(r"\[([^\]\[]+)\]", message)
+                    if match is None:
+                        continue
+                    index = match.group(1)
+                else:
+                    match = SLOWLOG_TEXT.search(line)
+                    if match is None:
+                        continue
+                    index, took, source = match.group("index", "took", "source")
+                body = json.loads(source) if isinstance(source, str) else source
+            except ValueError as ex:
+                LOG.warning("Skipping invalid slowlog entry in '%s': %s", filename, ex)
+                continue
+            if isinstance(body, dict):
+                yield index, int(took) / 1000., body
+
+
+@dataclasses.dataclass
+class LoadStep:
+    """Step of a load profile, sending requests at a constant total rate for duration seconds."""
+    rate: float
+    duration: float
+    # Requests sent, and latency of their responses
+    requests: int = 0
+    histogram: Histogram = dataclasses.field(default_factory=Histogram, repr=False)
+
+    def to_dict(self) -> dict[str, Any]:
+        p50, p90, p99, p999 = self.histogram.percentiles(50., 90., 99., 99.9)
+        return {
+            "rate": self.rate,
+            "duration": self.duration,
+            "requests": self.requests,
+            "responses": self.histogram.count,
+            "throughput": self.histogram.count / self.duration if self.duration > 0. else 0.,
+            "mean": self.histogram.mean,
+            "p50": p50,
+            "p90": p90,
+            "p99": p99,
+            "p99.9": p999,
+            "max": self.histogram.max,
+        }
+
+
+def load_profile(filename: str = LOAD_PROFILE_FILENAME) -> list[LoadStep]:
+    """It loads a load profile as the list of its steps.
+
+    The profile is a list of stages, each one being either a step ('rate' and 'duration' fields) or a ramp
+    ('ramp' as [first rate, last rate], 'duration' and 'steps' fields) expanded into steps evenly splitting
+    its duration. A spike is a short step.
+    """
+    LOG.debug("Loading load profile from '%s'.", filename)
+    try:
+        with open(filename) as f:
+            stages = json.load(f)
+        steps: list[LoadStep] = []
+        for stage in stages:
+            duration = float(stage["duration"])
+            if "ramp" in stage:
+                first, last = (float(r) for r in stage["ramp"])
+                count = max(1, int(stage.get("steps", 10)))
+                for i in range(count):
+                    rate = first + (last - first) * (i / (count - 1) if count > 1 else 1.)
+                    steps.append(LoadStep(rate=rate, duration=duration / count))
+            else:
+                steps.append(LoadStep(rate=float(stage["rate"]), duration=duration))
+        if not steps or any(s.rate <= 0. or s.duration <= 0. for s in steps):
+            raise ValueError(f"Load profile in '{filename}' must have steps with positive rates and durations.")
+        return steps
+    finally:
+        LOG.debug("Terminated loading load profile from '%s'.", filename)
+
+
+def latency_knee(steps: Sequence[LoadStep], threshold: float = LATENCY_THRESHOLD) -> LoadStep | None:
+    """It returns the first step having p99 latency above threshold, or None when there isn't any."""
+    for step in steps:
+        if step.histogram.count and step.histogram.percentiles(99.)[0] > threshold:
+            return step
+    return None
+
+
 def send_queries(
-    queries: Iterable[Query],
-    durations: dict[str, list[float]],
+    queries: Iterable[Probe],
+    interval: float = QUERY_INTERVAL,
+    test_duration: float | None = TEST_DURATION,
+    rate: float | None = QUERY_RATE,
+    concurrency: int = CONCURRENCY,
+    rate_limit: float | None = RATE_LIMIT,
+    burst: int = RATE_BURST,
+    stagger: bool = STAGGER,
+) -> Iterator[QueryResult]:
+    """Sends every query on its own independent timer and yields results as soon as they arrive.
+
+    Queries are sent concurrently by an asyncio event loop running on a background thread, so a slow
+    query cannot delay the others, and the sampling rate of each query does not depend on how many
+    queries there are.
+
+    Queries having a rate (from queries file or from rate parameter) are sent in open-loop mode, the
+    others are sent in closed-loop mode by concurrency tasks per query, each one sending a request every
+    interval seconds (or as soon as the previous response arrives when it's late), and then waiting for the
+    tokens of query and global rate limits (see TokenBucket) when it has any. The tasks of a query send
+    their requests together, unless stagger is true, making their schedules evenly staggered over the interval.
+    """
+    queries = list(queries)
+    limiter = TokenBucket(rate=rate_limit, burst=burst) if rate_limit else None
+
+    def probe(q: Probe, emit: Callable[[QueryResult], None]) -> list[Awaitable[None]]:
+        limiters = [b for b in (q.limiter, limiter) if b is not None]
+        if q.rate or rate:
+            return [probe_query_open_loop(q, emit=emit, rate=q.rate or rate, limiters=limiters,
+                                          phase=q.phase, jitter=q.jitter)]
+        return [probe_query(q, emit=emit, interval=interval, limiters=limiters,
+                            phase=q.phase + (i * interval / concurrency if stagger else 0.), jitter=q.jitter)
+                for i in range(concurrency)]
+
+    async def engine(emit: Callable[[QueryResult], None]) -> None:
+        tasks: list[asyncio.Task] = []
+        try:
+            check_pool_size([q for q in queries if not (q.rate or rate)], concurrency=concurrency)
+            await warm_up_async(queries, emit=emit)
+            tasks = [asyncio.create_task(p) for q in queries for p in probe(q, emit)]
+            await asyncio.wait_for(asyncio.gather(*tasks), timeout=test_duration)
+        except asyncio.TimeoutError:
+            LOG.warning("Test duration expired.")
+        finally:
+            for task in tasks:
+                task.cancel()
+            await close_async_clients({q.cluster for q in queries})
+
+    return iter_async(engine)
+
+
+def send_queries_threaded(
+    queries: Iterable[Probe],
     interval: float = QUERY_INTERVAL,
     test_duration: float | None = TEST_DURATION,
+    rate: float | None = QUERY_RATE,
+    concurrency: int = CONCURRENCY,
+    rate_limit: float | None = RATE_LIMIT,
+    burst: int = RATE_BURST,
+    stagger: bool = STAGGER,
 ) -> Iterator[QueryResult]:
+    """Sends queries from a pool of threads, keeping up to concurrency requests in flight for every query.
+
+    Every worker thread sends its query in closed-loop mode, scheduling requests every interval seconds (and
+    then waiting for rate limits tokens) as send_queries function does. Results of all workers are funneled
+    through a single queue and yielded as soon as they arrive. Open-loop mode is not supported, so queries
+    can't have a rate.
+    """
+    queries = list(queries)
+    for q in queries:
+        if q.rate or rate:
+            raise ValueError(f"Query '{q.key}' has a rate, which is not supported by threads engine.")
+    results: queue.Queue[QueryResult] = queue.Queue()
+    stopped = threading.Event()
+    limiter = TokenBucket(rate=rate_limit, burst=burst) if rate_limit else None
+
+    def work(query: Probe, phase: float) -> None:
+        limiters = [b for b in (query.limiter, limiter) if b is not None]
+        schedule = Schedule(interval, phase=phase, jitter=query.jitter)
+        while not stopped.is_set():
+            deadline = schedule.next(skip_missed=True)
+            if stopped.wait(max(0., deadline - time.monotonic())):
+                break
+            lag = time.monotonic() - deadline
+            if not all(b.wait(stopped) for b in limiters):
+                break
+            if LOG.isEnabledFor(logging.DEBUG):
+                LOG.debug("Sending query '%s'...", query.key)
+            METRICS.request_started(query.key)
+            try:
+                for r in as_results(query.send()):
+                    r.schedule_lag = lag
+                    results.put(r)
+            except Exception as ex:
+                LOG.exception("Query '%s' failed: %s", query.key, ex)
+                METRICS.request_failed(query.key)
+            finally:
+                METRICS.request_finished(query.key)
+
+    check_pool_size(queries, concurrency=concurrency)
+    yield from warm_up(queries)
+
     test_deadline: float | None = None
     if test_duration is not None:
-        test_deadline = time.monotonic() + TEST_DURATION
+        test_deadline = time.monotonic() + test_duration
 
-    while True:
-        for query in queries:
-            if test_deadline and time.monotonic() < test_deadline:
-                LOG.warning("Test duration expired.", query.name)
+    # Workers are daemon threads, so that termination is not delayed by pending requests
+    workers = [threading.Thread(target=work, args=(q, q.phase + (i * interval / concurrency if stagger else 0.)),
+                                name=f"esprober-worker-{q.key}-{i}", daemon=True)
+               for q in queries for i in range(concurrency)]
+    LOG.debug("Starting %d worker threads...", len(workers))
+    for w in workers:
+        w.start()
+    try:
+        while True:
+            timeout: float | None = None
+            if test_deadline is not None:
+                timeout = test_deadline - time.monotonic()
+                if timeout <= 0.:
+                    LOG.warning("Test duration expired.")
+                    break
+            try:
+                yield results.get(timeout=timeout)
+            except queue.Empty:
+                continue
+    finally:
+        stopped.set()
+
+
+def replay_requests(
+    queries: Iterable[Probe] = (),
+    filename: str = REPLAY_FILENAME,
+    speed: float = REPLAY_SPEED,
+    test_duration: float | None = TEST_DURATION,
+    clusters_filename: str = CLUSTERS_FILENAME,
+    shard: tuple[int, int] = (0, 1),
+) -> Iterator[QueryResult]:
+    """Replays a capture of search requests, preserving their inter-arrival times divided by speed.
+
+    Requests are streamed from the capture file (see read_capture) and sent in open-loop mode to every
+    cluster (see load_clusters), measuring durations from the time they were intended to be sent. Results
+    are named after the request class of the captured requests, so queries are not used. Worker processes
+    replay their shard of the capture only, timed from the first request of the whole capture.
+    """
+    clusters = load_clusters(clusters_filename)
+
+    async def replay(emit: Callable[[QueryResult], None], in_flight: set[asyncio.Task]) -> None:
+        start_time = time.monotonic()
+        first_timestamp = next((timestamp for timestamp, _ in read_capture(filename)), 0.)
+        count = 0
+        for timestamp, query in read_capture(filename, shard=shard):
+            intended_time = start_time + (timestamp - first_timestamp) / speed
+            delay = intended_time - time.monotonic()
+            if delay > 0.:
+                await asyncio.sleep(delay)
+            lag = time.monotonic() - intended_time
+            for c in clusters:
+                task = asyncio.create_task(send_query(dataclasses.replace(query, cluster=c), emit=emit,
+                                                      start_time=intended_time, schedule_lag=lag))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+            count += 1
+        LOG.info("Replayed %d requests from '%s'.", count, filename)
+        if in_flight:
+            await asyncio.wait(set(in_flight))
+
+    async def engine(emit: Callable[[QueryResult], None]) -> None:
+        in_flight: set[asyncio.Task] = set()
+        try:
+            await asyncio.wait_for(replay(emit, in_flight), timeout=test_duration)
+        except asyncio.TimeoutError:
+            LOG.warning("Test duration expired.")
+        finally:
+            for task in in_flight:
+                task.cancel()
+            await close_async_clients(clusters)
+
+    return iter_async(engine)
+
+
+def send_load_profile(
+    queries: Iterable[Probe],
+    filename: str = LOAD_PROFILE_FILENAME,
+    report_filename: str = PROFILE_REPORT_FILENAME,
+    threshold: float = LATENCY_THRESHOLD,
+    request_timeout: float = REQUEST_TIMEOUT,
+) -> Iterator[QueryResult]:
+    """Executes a load profile (see load_profile), sending queries in turn in open-loop mode at step rates.
+
+    Latency percentiles of the responses to the requests sent during every step are logged and written as JSON
+    to report_filename, together with the step the p99 latency crosses threshold at (the latency knee). The
+    report only covers requests sent by this process, so profiles can't be sent by worker processes.
+    """
+    queries = list(queries)
+    steps = load_profile(filename)
+
+    async def run_step(step: LoadStep, probes: Iterator[Probe], emit: Callable[[QueryResult], None],
+                       in_flight: set[asyncio.Task]) -> None:
+        LOG.info("Sending %f requests per second for %f seconds...", step.rate, step.duration)
+        schedule = Schedule(1. / step.rate)
+        end_time = schedule.start_time + step.duration
+        while True:
+            intended_time = schedule.next()
+            if intended_time >= end_time:
                 break
+            delay = intended_time - time.monotonic()
+            if delay > 0.:
+                await asyncio.sleep(delay)
+            lag = time.monotonic() - intended_time
+            task = asyncio.create_task(
+                send_query(next(probes), emit=emit, start_time=intended_time, schedule_lag=lag))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            step.requests += 1
+        await asyncio.sleep(max(0., end_time - time.monotonic()))
+
+    async def engine(emit: Callable[[QueryResult], None]) -> None:
+        in_flight: set[asyncio.Task] = set()
+        try:
+            await warm_up_async(queries, emit=emit)
+            probes = itertools.cycle(queries)
+            for step in steps:
+
+                def emit_step(result: QueryResult, step: LoadStep = step) -> None:
+                    step.histogram.record(result.duration)
+                    emit(result)
 
-            LOG.info("Sending query '%s'...", query.name)
+                await run_step(step, probes, emit_step, in_flight)
+            if in_flight:
+                await asyncio.wait(set(in_flight), timeout=request_timeout)
+        finally:
+            for task in in_flight:
+                task.cancel()
+            await close_async_clients({q.cluster for q in queries})
+
+    try:
+        yield from iter_async(engine)
+    finally:
+        report = {"threshold": threshold, "steps": [step.to_dict() for step in steps], "knee": None}
+        for i, step in enumerate(steps):
+            d = step.to_dict()
+            LOG.info("Load step %d: rate=%f throughput=%f requests=%d responses=%d p50=%f p90=%f p99=%f max=%f",
+                     i, d["rate"], d["throughput"], d["requests"], d["responses"], d["p50"], d["p90"], d["p99"],
+                     d["max"])
+        knee = latency_knee(steps, threshold=threshold)
+        if knee is None:
+            LOG.info("p99 latency didn't cross %f seconds.", threshold)
+        else:
+            report["knee"] = knee.to_dict()
+            LOG.warning("p99 latency crossed %f seconds at %f requests per second.", threshold, knee.rate)
+        with open(report_filename, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def send_queries_multiprocess(
+    queries: Iterable[Probe],
+    processes: int = PROCESSES,
+    engine: str = ENGINE,
+    log_filename: str = LOG_FILENAME,
+    stop_timeout: float = 5.,
+) -> Iterator[QueryResult]:
+    """Sends queries from worker processes, each one running its own engine and clients.
+
+    Workers stream results back as compact tuples of field values, which are yielded by this (coordinator)
+    process as soon as they arrive. Rates and concurrency apply to every worker process, while rate limits
+    are split evenly among them. Workers still running when it stops are terminated, and killed when they
+    don't exit within stop_timeout seconds.
+    """
+    if engine == "profile":
+        raise ValueError("Load profiles can't be sent by multiple worker processes: set ESPROBER_PROCESSES to 1.")
+    queries = list(queries)
+    results: multiprocessing.Queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=run_worker, args=(queries, engine, results, log_filename, i, processes),
+                                       name=f"esprober-worker-{i}", daemon=True)
+               for i in range(processes)]
+    LOG.debug("Starting %d worker processes...", len(workers))
+    for w in workers:
+        w.start()
+    running = len(workers)
+    try:
+        while running:
             try:
-                result = query.send()
-            except Exception as ex:
-                LOG.exception("Query '%s' failed: %s", query.name, ex)
+                record = results.get(timeout=1.)
+            except queue.Empty:
+                if not any(w.is_alive() for w in workers):
+                    LOG.error("All worker processes terminated unexpectedly.")
+                    break
+                continue
+            if record is None:
+                running -= 1
             else:
-                durations[query.name].append(result.duration)
-                LOG.info("Query '%s' average time: %f seconds", query.name, average(durations[query.name]))
-                yield result
-            finally:
-                if interval > 0:
-                    # Give the service a fair break to reduce its charge
-                    LOG.debug("Sleeping %d seconds...", int(QUERY_INTERVAL))
-                    time.sleep(QUERY_INTERVAL)
+                yield QueryResult(*record)
+    finally:
+        stop_deadline = time.monotonic() + stop_timeout
+        if running:
+            for w in workers:
+                if w.is_alive():
+                    w.terminate()
+            # Workers can't exit before the results they put are flushed to the queue, so drain it
+            while running and any(w.is_alive() for w in workers):
+                timeout = stop_deadline - time.monotonic()
+                if timeout <= 0.:
+                    break
+                try:
+                    if results.get(timeout=min(timeout, 1.)) is None:
+                        running -= 1
+                except queue.Empty:
+                    continue
+        for w in workers:
+            w.join(timeout=max(0., stop_deadline - time.monotonic()))
+            if w.is_alive():
+                LOG.warning("Worker process %s didn't stop, killing it...", w.name)
+                w.kill()
+                w.join()
 
 
-def read_results(filename) -> Iterator[QueryResult]:
-    if not os.path.isfile(filename):
+def run_worker(
+    queries: list[Probe],
+    engine: str,
+    results: multiprocessing.Queue,
+    log_filename: str,
+    index: int = 0,
+    processes: int = 1,
+) -> None:
+    init_logging(log_filename)
+    # Every worker process has its own token buckets, so each one gets its share of rate limits
+    for q in queries:
+        if q.limiter is not None:
+            q.limiter = TokenBucket(rate=q.limiter.rate / processes, burst=q.limiter.burst // processes)
+    kwargs: dict[str, Any] = {}
+    if RATE_LIMIT and engine in ("async", "threads"):
+        kwargs.update(rate_limit=RATE_LIMIT / processes, burst=RATE_BURST // processes)
+    if engine == "replay":
+        kwargs.update(shard=(index, processes))
+    # Workers are stopped by the coordinator process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        for r in ENGINES[engine](queries=queries, **kwargs):
+            results.put(dataclasses.astuple(r))
+    except SystemExit as ex:
+        LOG.debug("Worker process stopped: %s", ex)
+    except Exception as ex:
+        LOG.exception("Worker process failed: %s", ex)
+    finally:
+        results.put(None)
+
+
+def check_pool_size(queries: Iterable[Probe], concurrency: int = CONCURRENCY, pool_size: int = POOL_SIZE) -> None:
+    """It warns about clusters whose pool of connections is smaller than the requests in flight of given queries,
+    sent in closed-loop mode by concurrency tasks each.
+
+    Requests waiting for a free connection would have this waiting time charged to their durations.
+    """
+    in_flight: dict[str, int] = {}
+    for q in queries:
+        name = q.cluster.name or q.cluster.url
+        in_flight[name] = in_flight.get(name, 0) + concurrency
+    for name, count in in_flight.items():
+        if count > pool_size:
+            LOG.warning("Cluster '%s' has up to %d requests in flight but only %d pooled connections: please "
+                        "set ESPROBER_POOL_SIZE to %d at least.", name, count, pool_size, count)
+
+
+def warm_up(
+    queries: list[Probe],
+    count: int = WARMUP_COUNT,
+    duration: float = WARMUP_DURATION,
+    pool_size: int = POOL_SIZE,
+    tag: bool = WARMUP_RESULTS == "tag",
+) -> Iterator[QueryResult]:
+    """It primes pooled connections by sending every query count times or for duration seconds.
+
+    Queries are sent in rounds of pool_size concurrent requests, so that every pooled connection gets
+    opened. Warm-up results are yielded only when they have to be tagged.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="esprober-warmup") as executor:
+        for round_queries in warm_up_rounds(queries, count=count, duration=duration, pool_size=pool_size):
+            for q, future in [(q, executor.submit(q.send)) for q in round_queries]:
+                try:
+                    results = as_results(future.result())
+                except Exception as ex:
+                    LOG.warning("Warm-up query '%s' failed: %s", q.key, ex)
+                    continue
+                if tag:
+                    for result in results:
+                        result.warmup = True
+                        yield result
+
+
+async def warm_up_async(
+    queries: list[Probe],
+    emit: Callable[[QueryResult], None],
+    count: int = WARMUP_COUNT,
+    duration: float = WARMUP_DURATION,
+    pool_size: int = POOL_SIZE,
+    tag: bool = WARMUP_RESULTS == "tag",
+) -> None:
+    """Asynchronous version of warm_up function, emitting warm-up results only when they have to be tagged."""
+
+    async def send(q: Probe) -> None:
+        try:
+            results = as_results(await q.async_send())
+        except Exception as ex:
+            LOG.warning("Warm-up query '%s' failed: %s", q.key, ex)
+            return
+        if tag:
+            for result in results:
+                result.warmup = True
+                emit(result)
+
+    for round_queries in warm_up_rounds(queries, count=count, duration=duration, pool_size=pool_size):
+        await asyncio.gather(*(send(q) for q in round_queries))
+
+
+def warm_up_rounds(queries: list[Probe], count: int, duration: float, pool_size: int) -> Iterator[list[Probe]]:
+    if not queries or (count <= 0 and duration <= 0.):
         return
-    LOG.debug("Reading results from '%s'.", filename)
+    LOG.info("Warming up %d queries (count: %d, duration: %f seconds)...", len(queries), count, duration)
+    # Every round has at least one request per query and one per pooled connection
+    round_queries = list(itertools.islice(itertools.cycle(queries), max(pool_size, len(queries))))
+    deadline = time.monotonic() + duration
+    rounds = 0
+    while rounds < count or time.monotonic() < deadline:
+        yield round_queries
+        rounds += 1
+    LOG.info("Warm-up terminated after %d rounds.", rounds)
+
+
+async def probe_query(
+    query: Probe,
+    emit: Callable[[QueryResult], None],
+    interval: float = QUERY_INTERVAL,
+    limiters: Sequence[TokenBucket] = (),
+    phase: float = 0.,
+    jitter: float = JITTER,
+) -> None:
+    """It sends a query in closed-loop mode, waiting for schedule deadlines and then for rate limits tokens."""
+    schedule = Schedule(interval, phase=phase, jitter=jitter)
+    while True:
+        deadline = schedule.next(skip_missed=True)
+        delay = deadline - time.monotonic()
+        if delay > 0.:
+            # Give the service a fair break to reduce its charge
+            LOG.debug("Query '%s' sleeping %f seconds...", query.key, delay)
+            await asyncio.sleep(delay)
+        lag = time.monotonic() - deadline
+        for limiter in limiters:
+            await limiter.acquire()
+        await send_query(query, emit=emit, schedule_lag=lag)
+
+
+async def probe_query_open_loop(
+    query: Probe,
+    emit: Callable[[QueryResult], None],
+    rate: float,
+    limiters: Sequence[TokenBucket] = (),
+    phase: float = 0.,
+    jitter: float = JITTER,
+) -> None:
+    """It sends a query at a constant arrival rate, regardless of outstanding responses.
+
+    Durations are measured from the time every request was intended to be sent, so when the service
+    stalls (or the prober can't keep up) the waiting time is charged to the results instead of being
+    silently omitted. Requests held back by query and global rate limits are measured from the time their
+    tokens became available instead, the time they waited for them being reported as schedule lag.
+    """
+    for limiter in limiters:
+        if limiter.rate < rate:
+            LOG.warning("Query '%s' rate (%f requests per second) is limited to %f requests per second.",
+                        query.key, rate, limiter.rate)
+    schedule = Schedule(1. / rate, phase=phase, jitter=jitter)
+    in_flight: set[asyncio.Task] = set()
+    LOG.debug("Query '%s' sending %f requests per second...", query.key, rate)
     try:
-        with open(filename, "r", newline="") as csv_file:
-            for row in csv.DictReader(csv_file):
-                yield QueryResult(
-                    timestamp=row["timestamp"],
-                    name=row["name"],
-                    duration=float(row["duration"]),
-                )
+        while True:
+            intended_time = schedule.next()
+            delay = intended_time - time.monotonic()
+            if delay > 0.:
+                await asyncio.sleep(delay)
+            start_time = intended_time
+            for limiter in limiters:
+                start_time = max(start_time, await limiter.acquire())
+            lag = time.monotonic() - intended_time
+            task = asyncio.create_task(send_query(query, emit=emit, start_time=start_time, schedule_lag=lag))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
     finally:
-        LOG.debug("Terminated reading results from '%s'.", filename)
+        for task in in_flight:
+            task.cancel()
 
 
-def write_results(filename: str, results: Iterable['QueryResult']) -> None:
-    out_dir = os.path.dirname(filename)
-    if out_dir and not os.path.isdir(out_dir):
-        os.makedirs(out_dir)
-    write_header = not os.path.isfile(filename)
-    LOG.debug("Start writing results to '%s'...", filename)
+async def send_query(
+    query: Probe,
+    emit: Callable[[QueryResult], None],
+    start_time: float | None = None,
+    schedule_lag: float | None = None,
+) -> None:
+    if LOG.isEnabledFor(logging.DEBUG):
+        LOG.debug("Sending query '%s'...", query.key)
+    METRICS.request_started(query.key)
     try:
-        with open(filename, "a", newline="") as fd:
-            writer = csv.DictWriter(fd, fieldnames=["timestamp", "name", "duration"])
-            if write_header:
-                LOG.debug("Writing header to '%s'...", filename)
-                writer.writeheader()
-            for r in results:
-                LOG.debug("Writing result to '%s' (result: %r)...", filename, r)
-                writer.writerow(dataclasses.asdict(r))
-                fd.flush()
+        results = as_results(await query.async_send(start_time=start_time))
+    except Exception as ex:
+        LOG.exception("Query '%s' failed: %s", query.key, ex)
+        METRICS.request_failed(query.key)
+    else:
+        for result in results:
+            result.schedule_lag = schedule_lag
+            emit(result)
+    finally:
+        METRICS.request_finished(query.key)
+
+
+def iter_async(engine: Callable[[Callable[[T], None]], Awaitable[None]]) -> Iterator[T]:
+    """Runs an asynchronous engine on a background event loop, yielding the items it emits.
+
+    Closing the returned iterator (or interrupting the consumer) cancels the engine and waits for it
+    to terminate.
+    """
+    items: queue.Queue = queue.Queue()
+    done = object()
+    errors: list[BaseException] = []
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(engine(items.put))
+
+    def run() -> None:
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        except BaseException as ex:
+            errors.append(ex)
+        finally:
+            loop.close()
+            items.put(done)
+
+    thread = threading.Thread(target=run, name="esprober-engine", daemon=True)
+    thread.start()
+    try:
+        while (item := items.get()) is not done:
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        if thread.is_alive():
+            with contextlib.suppress(RuntimeError):  # the loop could have just been closed
+                loop.call_soon_threadsafe(task.cancel)
+            thread.join()
+
+
+def read_summary(store: 'ResultsStore', summary_filename: str = SUMMARY_FILENAME) -> Summary:
+    """It loads the summary of a results store, reading only results appended since its last checkpoint."""
+    summary = Summary.load(summary_filename)
+    size = store.size()
+    if size < summary.offset:
+        LOG.warning("Results file '%s' is smaller than its summary offset: summary is discarded.", store.filename)
+        summary = Summary(filename=summary_filename)
+    if size > summary.offset:
+        for result in store.read(offset=summary.offset):
+            if not result.warmup:
+                summary.record(result)
+        summary.checkpoint(size, interval=0.)
+    return summary
+
+
+def write_results(
+    store: 'ResultsStore',
+    results: Iterable['QueryResult'],
+    commit: Callable[[Sequence['QueryResult'], int], None] | None = None,
+    batch_size: int = WRITE_BATCH_SIZE,
+    interval: float = WRITE_INTERVAL,
+) -> None:
+    """It appends results to a results store in batches.
+
+    Pending results are written as soon as there are batch_size of them, every interval seconds, and
+    when terminating. After every written batch, commit (when given) is called with the batch and the new
+    size of the store.
+    """
+    pending: list[QueryResult] = []
+    pending_lock = threading.Lock()
+    write_lock = threading.Lock()
+    stopped = threading.Event()
+    LOG.debug("Start writing results to '%s'...", store.filename)
+    try:
+        with store.writer() as write:
+
+            def flush() -> None:
+                with write_lock:
+                    with pending_lock:
+                        batch = pending.copy()
+                        pending.clear()
+                    if not batch:
+                        return
+                    offset = write(batch)
+                    LOG.debug("Written %d results to '%s'.", len(batch), store.filename)
+                    if commit is not None:
+                        commit(batch, offset)
+
+            def flush_periodically() -> None:
+                while not stopped.wait(interval):
+                    flush()
+
+            flusher = threading.Thread(target=flush_periodically, name="esprober-writer", daemon=True)
+            flusher.start()
+            try:
+                for r in results:
+                    with pending_lock:
+                        pending.append(r)
+                        full = len(pending) >= batch_size
+                    if full:
+                        flush()
+            finally:
+                stopped.set()
+                flusher.join()
+                flush()
     finally:
-        LOG.debug("Terminated writing results to '%s'.", filename)
+        LOG.debug("Terminated writing results to '%s'.", store.filename)
+
 
+def terminate(signum: int, frame: Any) -> None:
+    raise SystemExit(f"Terminated by signal {signal.Signals(signum).name}.")
 
-def average(durations: list[float]) -> float:
-    if not durations:
-        return 0.
-    return sum(durations) / len(durations)
+
+ENGINES: dict[str, Callable[..., Iterator[QueryResult]]] = {
+    "async": send_queries,
+    "threads": send_queries_threaded,
+    "replay": replay_requests,
+    "profile": send_load_profile,
+}
+
+
+def log_latency(name: str, histogram: Histogram) -> None:
+    p50, p90, p99, p999 = histogram.percentiles(50., 90., 99., 99.9)
+    LOG.info(
+        "Query '%s' latency (%d samples): mean=%f p50=%f p90=%f p99=%f p99.9=%f max=%f seconds",
+        name, histogram.count, histogram.mean, p50, p90, p99, p999, histogram.max
+    )
+
+
+def utc_timestamp(monotonic_time: float | None = None) -> str:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if monotonic_time is not None:
+        now -= datetime.timedelta(seconds=time.monotonic() - monotonic_time)
+    return datetime.datetime.strftime(now, "%Y-%m-%dT%H:%M:%S.%f")[:-3]
+
+
+@dataclasses.dataclass
+class RequestTimings:
+    """Durations (in seconds) of the phases of a request, as measured by instrumented client transport.
+
+    - connect_time: TCP connection setup (it includes TLS handshake for asynchronous clients);
+    - tls_time: TLS handshake;
+    - ttfb: from sending the request (once connected) to receiving response headers;
+    - download_time: from receiving response headers to receiving the whole response body;
+    - decode_time: JSON deserialization of response body.
+    Connection phases are None when the request reused a pooled connection.
+
+    When discard_hits is true the response body is decoded only up to the hits array (see TimedJsonSerializer).
+    The timestamp and the whole duration of the request are set by timed_request function.
+    """
+    timestamp: str = ""
+    duration: float = 0.
+    connect_time: float | None = None
+    tls_time: float | None = None
+    ttfb: float | None = None
+    download_time: float | None = None
+    decode_time: float | None = None
+    response_bytes: int | None = None
+    discard_hits: bool = dataclasses.field(default=False, repr=False)
+    # Monotonic times the phases being measured started at
+    request_started: float | None = dataclasses.field(default=None, repr=False)
+    connected: float | None = dataclasses.field(default=None, repr=False)
+    headers_received: float | None = dataclasses.field(default=None, repr=False)
+
+    def on_request_start(self) -> None:
+        self.request_started = time.monotonic()
+
+    def on_connected(self, connect_time: float, tls_time: float | None = None) -> None:
+        self.connected = time.monotonic()
+        self.connect_time = connect_time
+        self.tls_time = tls_time
+
+    def on_headers_received(self) -> None:
+        self.headers_received = time.monotonic()
+        # The connection could have been established after starting the request
+        sent = max(t for t in (self.request_started, self.connected, 0.) if t is not None)
+        if sent:
+            self.ttfb = self.headers_received - sent
+
+    def on_body_received(self, size: int) -> None:
+        self.response_bytes = size
+        if self.headers_received is not None:
+            self.download_time = time.monotonic() - self.headers_received
+
+
+# Timings of the request being sent from current thread or asyncio task
+REQUEST_TIMINGS: contextvars.ContextVar[RequestTimings | None] = contextvars.ContextVar("REQUEST_TIMINGS", default=None)
+
+
+@contextlib.contextmanager
+def timed_request(start_time: float | None = None, discard_hits: bool = False) -> Iterator[RequestTimings]:
+    """It collects the timings of the request sent in its context from current thread or asyncio task.
+
+    The duration of the request is measured since start_time (monotonic), or since now when it is None.
+    """
+    if start_time is None:
+        start_time = time.monotonic()
+    timings = RequestTimings(timestamp=utc_timestamp(start_time), discard_hits=discard_hits)
+    token = REQUEST_TIMINGS.set(timings)
+    try:
+        yield timings
+    finally:
+        REQUEST_TIMINGS.reset(token)
+    timings.duration = time.monotonic() - start_time
+
+
+class TimedHTTPResponse(http.client.HTTPResponse):
+
+    def begin(self) -> None:
+        super().begin()
+        timings = REQUEST_TIMINGS.get()
+        if timings is not None:
+            timings.on_headers_received()
+
+
+class TimedHTTPConnectionMixin:
+    response_class = TimedHTTPResponse
+    _tcp_connect_time: float | None = None
+
+    def _new_conn(self) -> Any:
+        start_time = time.monotonic()
+        sock = super()._new_conn()  # type: ignore[misc]
+        self._tcp_connect_time = time.monotonic() - start_time
+        return sock
+
+    def connect(self) -> None:
+        start_time = time.monotonic()
+        super().connect()  # type: ignore[misc]
+        timings = REQUEST_TIMINGS.get()
+        if timings is not None and self._tcp_connect_time is not None:
+            tls_time = None
+            if isinstance(self, urllib3.connection.HTTPSConnection):
+                tls_time = time.monotonic() - start_time - self._tcp_connect_time
+            timings.on_connected(self._tcp_connect_time, tls_time)
+
+    def request(self, *args: Any, **kwargs: Any) -> None:
+        timings = REQUEST_TIMINGS.get()
+        if timings is not None:
+            timings.on_request_start()
+        super().request(*args, **kwargs)  # type: ignore[misc]
+
+
+class TimedHTTPConnection(TimedHTTPConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedHTTPConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+
+class TimedUrllib3HttpNode(elastic_transport.Urllib3HttpNode):
+    """Synchronous transport node recording request phases to REQUEST_TIMINGS."""
+
+    def __init__(self, config: elastic_transport.NodeConfig):
+        super().__init__(config)
+        if isinstance(self.pool, urllib3.HTTPSConnectionPool):
+            self.pool.ConnectionCls = TimedHTTPSConnection
+        else:
+            self.pool.ConnectionCls = TimedHTTPConnection
+
+
+class TimedAiohttpHttpNode(elastic_transport.AiohttpHttpNode):
+    """Asynchronous transport node recording request phases to REQUEST_TIMINGS."""
+
+    def _create_aiohttp_session(self) -> None:
+        super()._create_aiohttp_session()
+        assert self.session is not None
+        self.session.trace_configs.append(aiohttp_trace_config())
 
 
 @functools.cache
-def client(url: str) -> elasticsearch.Elasticsearch:
-    c = elasticsearch.Elasticsearch(url).options(api_key=API_KEY, request_timeout=REQUEST_TIMEOUT)
-    if API_KEY:
-        c = c.options(api_key=API_KEY)
-    return c
+def aiohttp_trace_config() -> aiohttp.TraceConfig:
+    # Trace callbacks are awaited by the task sending the request, so they see its REQUEST_TIMINGS
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(session: Any, context: Any, params: Any) -> None:
+        timings = REQUEST_TIMINGS.get()
+        if timings is not None:
+            timings.on_request_start()
+
+    async def on_connection_create_start(session: Any, context: Any, params: Any) -> None:
+        context.connection_create_started = time.monotonic()
+
+    async def on_connection_create_end(session: Any, context: Any, params: Any) -> None:
+        timings = REQUEST_TIMINGS.get()
+        if timings is not None:
+            timings.on_connected(time.monotonic() - context.connection_create_started)
+
+    async def on_request_end(session: Any, context: Any, params: Any) -> None:
+        timings = REQUEST_TIMINGS.get()
+        if timings is not None:
+            timings.on_headers_received()
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.freeze()
+    return trace_config
+
+
+class TimedJsonSerializer(elasticsearch.JsonSerializer):
+    """JSON serializer recording response body size and deserialization time to REQUEST_TIMINGS."""
+
+    # Search responses report their statistics ahead of the hits array
+    HITS_ARRAY = b'"hits":['
+
+    def loads(self, data: bytes) -> Any:
+        timings = REQUEST_TIMINGS.get()
+        if timings is None:
+            return super().loads(data)
+        timings.on_body_received(len(data))
+        start_time = time.monotonic()
+        try:
+            if timings.discard_hits:
+                return self.loads_head(data)
+            return super().loads(data)
+        finally:
+            timings.decode_time = time.monotonic() - start_time
+
+    def loads_head(self, data: bytes) -> Any:
+        """It decodes a search response skipping everything from the hits array on (hits and aggregations)."""
+        end = data.find(self.HITS_ARRAY)
+        if end < 0:
+            return super().loads(data)
+        try:
+            head = super().loads(data[:end] + b'"hits":[]}}')
+        except elasticsearch.SerializationError:
+            head = None
+        if not isinstance(head, dict) or "hits" not in head:
+            # The hits array found isn't the one of the top level hits object
+            return super().loads(data)
+        return head
+
+
+@functools.cache
+def client(cluster: Cluster = Cluster()) -> elasticsearch.Elasticsearch:
+    """It returns the client of a cluster, sharing a single pool of connections for all queries."""
+    c = elasticsearch.Elasticsearch(
+        cluster.url,
+        node_class=TimedUrllib3HttpNode,
+        serializers={TimedJsonSerializer.mimetype: TimedJsonSerializer()},
+        connections_per_node=POOL_SIZE,
+    )
+    return c.options(**client_options(cluster))
+
+
+@functools.cache
+def async_client(cluster: Cluster = Cluster()) -> elasticsearch.AsyncElasticsearch:
+    """It returns the asynchronous client of a cluster, sharing a single pool of connections for all queries."""
+    c = elasticsearch.AsyncElasticsearch(
+        cluster.url,
+        node_class=TimedAiohttpHttpNode,
+        serializers={TimedJsonSerializer.mimetype: TimedJsonSerializer()},
+        connections_per_node=POOL_SIZE,
+    )
+    return c.options(**client_options(cluster))
+
+
+def client_options(cluster: Cluster) -> dict[str, Any]:
+    options: dict[str, Any] = {"request_timeout": REQUEST_TIMEOUT}
+    if cluster.api_key:
+        options["api_key"] = cluster.api_key
+    if not KEEP_ALIVE:
+        # Every request is going to pay for connection setup
+        options["headers"] = {"connection": "close"}
+    return options
+
+
+async def close_async_clients(clusters: Iterable[Cluster]) -> None:
+    # Async clients are bound to the event loop they have been used from
+    for cluster in clusters:
+        await async_client(cluster).close()
+    async_client.cache_clear()
 
 
 if __name__ == "__main__":
-    main()
+    cli()
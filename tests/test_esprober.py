@@ -0,0 +1,172 @@
+import gzip
+import json
+import math
+import os
+import random
+
+import pytest
+
+import esprober
+
+
+def exact_percentile(values: list[float], p: float) -> float:
+    return sorted(values)[max(1, math.ceil(p / 100. * len(values))) - 1]
+
+
+@pytest.mark.parametrize("significant_digits", [1, 2, 3])
+def test_histogram_index_covers_values(significant_digits: int) -> None:
+    h = esprober.Histogram(significant_digits=significant_digits)
+    rng = random.Random(1)
+    values = list(range(1024)) + [rng.randrange(h._highest_units) for _ in range(10000)]
+    for value in values:
+        index = h._index(value)
+        highest = h._highest_equivalent(index)
+        # Every value falls in the range of its index, and ranges are contiguous
+        assert value <= highest
+        assert h._index(highest) == index
+        assert h._index(highest + 1) == index + 1
+        # Range sizes respect histogram precision
+        assert highest - value <= max(1, value * 10. ** -significant_digits)
+
+
+def test_histogram_percentiles_match_exact_sort() -> None:
+    rng = random.Random(2)
+    values = [rng.lognormvariate(-4., 1.5) for _ in range(20000)]
+    h = esprober.Histogram()
+    for value in values:
+        h.record(value)
+    assert h.count == len(values)
+    assert h.max == max(values)
+    assert h.mean == pytest.approx(sum(values) / len(values))
+    percentiles = [1., 50., 90., 99., 99.9, 100.]
+    for p, value in zip(percentiles, h.percentiles(*percentiles)):
+        exact = exact_percentile(values, p)
+        assert exact - h.UNIT <= value <= exact * 1.01 + h.UNIT, p
+
+
+def test_histogram_merge_and_subtract() -> None:
+    rng = random.Random(3)
+    first, second = [rng.expovariate(20.) for _ in range(1000)], [rng.expovariate(5.) for _ in range(1000)]
+    h1, h2, both = esprober.Histogram(), esprober.Histogram(), esprober.Histogram()
+    for value in first:
+        h1.record(value)
+        both.record(value)
+    for value in second:
+        h2.record(value)
+        both.record(value)
+    merged = h1.copy()
+    merged.merge(h2)
+    assert merged.to_dict() == pytest.approx(both.to_dict())
+    merged.subtract(h2)
+    assert merged.counts == h1.counts
+    assert merged.count == h1.count
+    assert esprober.Histogram.from_dict(json.loads(json.dumps(h1.to_dict()))).to_dict() == h1.to_dict()
+
+
+def make_results(count: int, name: str = "q") -> list[esprober.QueryResult]:
+    rng = random.Random(count)
+    return [
+        esprober.QueryResult(
+            timestamp=f"2024-01-01T00:00:{i % 60:02d}.{i % 1000:03d}",
+            name=f"{name}{i % 3}",
+            duration=rng.random(),
+            took=None if i % 4 else rng.random(),
+            timed_out=None if i % 5 else bool(i % 2),
+            hits=i,
+            warmup=i % 7 == 0,
+            cluster=None if i % 2 else "c",
+        )
+        for i in range(count)
+    ]
+
+
+@pytest.fixture(params=["csv", "columnar"])
+def store(request: pytest.FixtureRequest, tmp_path: str) -> esprober.ResultsStore:
+    return esprober.results_store(os.path.join(tmp_path, "results"), request.param)
+
+
+def test_results_store_round_trip(store: esprober.ResultsStore) -> None:
+    results = make_results(100)
+    with store.writer() as write:
+        size = write(results[:60])
+        assert size == store.size()
+        size = write(results[60:])
+    assert list(store.read()) == results
+    assert list(store.read(offset=size)) == []
+
+
+def test_results_store_arrays(store: esprober.ResultsStore) -> None:
+    pytest.importorskip("numpy")
+    results = make_results(100)
+    with store.writer() as write:
+        write(results)
+    arrays = store.arrays()
+    names = store.dictionary("name")
+    assert [names[code] for code in arrays["name"]] == [r.name for r in results]
+    assert arrays["duration"].tolist() == [r.duration for r in results]
+    assert arrays["warmup"].tolist() == [int(r.warmup) for r in results]
+    assert arrays["timed_out"].tolist() == [255 if r.timed_out is None else int(r.timed_out) for r in results]
+    assert [str(t)[:23] for t in arrays["timestamp"]] == [r.timestamp for r in results]
+
+
+def test_columnar_store_recovers_from_truncated_files(tmp_path: str) -> None:
+    store = esprober.ColumnarResultsStore(os.path.join(tmp_path, "results"))
+    results = make_results(50)
+    with store.writer() as write:
+        write(results[:20])
+    # Simulate a crash while writing a new row and a new dictionary string
+    with open(store.column_filename("duration"), "ab") as f:
+        f.write(b"\x01\x02\x03")
+    with open(store.dictionary_filename("name"), "a") as f:
+        f.write('"torn')
+    assert list(store.read()) == results[:20]
+    with store.writer() as write:
+        write(results[20:])
+    assert list(store.read()) == results
+    assert store.dictionary("name") == ["q0", "q1", "q2"]
+
+
+def test_csv_store_skips_partially_written_row(tmp_path: str) -> None:
+    pytest.importorskip("numpy")
+    store = esprober.CSVResultsStore(os.path.join(tmp_path, "results.csv"))
+    results = make_results(20)
+    with store.writer() as write:
+        write(results)
+    with open(store.filename, "a") as f:
+        f.write("2024-01-01T00:00:00.000,q0,0.")
+    assert len(store.arrays()["duration"]) == len(results)
+
+
+SLOWLOG_LINES = [
+    "[2024-01-01T00:00:00,000][WARN ][i.s.s.query              ] [node-1] [logs][0] took[1.2s], took_millis[1200], "
+    "total_hits[10 hits], types[], stats[], search_type[QUERY_THEN_FETCH], total_shards[5], "
+    'source[{"query":{"term":{"user":"bob"}},"size":10}], id[], ',
+    "[2024-01-01T00:00:01,000][WARN ][i.s.s.query              ] [node-1] [logs][1] took[2.5s], took_millis[2500], "
+    "total_hits[10 hits], types[], stats[], search_type[QUERY_THEN_FETCH], total_shards[5], "
+    'source[{"query":{"term":{"user":"alice"}},"size":10}], id[], ',
+    "some unrelated line",
+    json.dumps({
+        "elasticsearch.slowlog.message": "[metrics][0]",
+        "elasticsearch.slowlog.took_millis": 900,
+        "elasticsearch.slowlog.source": '{"query":{"terms":{"host":["a","b","c"]}}}',
+    }),
+    json.dumps({"message": "[metrics][1]", "took_millis": "300", "source": '{"query":{"terms":{"host":["d"]}}}'}),
+]
+
+
+@pytest.mark.parametrize("suffix", ["", ".gz"])
+def test_read_slowlog(tmp_path: str, suffix: str) -> None:
+    filename = os.path.join(tmp_path, "slowlog.log" + suffix)
+    opener = gzip.open if suffix else open
+    with opener(filename, "wt") as f:
+        f.write("\n".join(SLOWLOG_LINES) + "\n")
+    assert list(esprober.read_slowlog(filename)) == [
+        ("logs", 1.2, {"query": {"term": {"user": "bob"}}, "size": 10}),
+        ("logs", 2.5, {"query": {"term": {"user": "alice"}}, "size": 10}),
+        ("metrics", .9, {"query": {"terms": {"host": ["a", "b", "c"]}}}),
+        ("metrics", .3, {"query": {"terms": {"host": ["d"]}}}),
+    ]
+
+    shapes = esprober.import_slowlog([filename])
+    assert [(s.index, s.count, s.max_took) for s in shapes] == [("logs", 2, 2.5), ("metrics", 2, .9)]
+    assert shapes[0].body == {"query": {"term": {"user": "alice"}}, "size": 10}